@@ -1,5 +1,6 @@
 from lxml import etree
 import os
+import stat
 import sys
 import pprint
 
@@ -45,7 +46,32 @@ def parse_opf(opf_file):
         #     out['aggregation'] = [ aggregation ]
     return out
 
-def scan_calibre_tree(tree):
+def file_manifest(path):
+    # the mtime of the directory changes when a file is added,
+    # removed or replaced
+    # before the listing, so a change in between is caught next time
+    manifest = {
+        "mtime": os.stat(path).st_mtime_ns,
+        "files": [],
+    }
+    for name in sorted(os.listdir(path)):
+        try:
+            st = os.stat(os.path.join(path, name))
+        except OSError:
+            # dangling symlink or removed meanwhile
+            continue
+        if stat.S_ISREG(st.st_mode):
+            manifest['files'].append({
+                "name": name,
+                "ext": os.path.splitext(name)[1],
+                "size": st.st_size,
+                "mtime": st.st_mtime_ns,
+            })
+    return manifest
+
+def scan_calibre_tree(tree, manifests=None):
+    # manifests: book directory => file_manifest() of the previous
+    # scan, reused if the directory did not change
     records = []
     for root, dirs, files in os.walk(tree):
         for hidden in [ d for d in dirs if d.startswith('.') ]:
@@ -55,6 +81,11 @@ def scan_calibre_tree(tree):
             metadata = parse_opf(os.path.join(root, 'metadata.opf'))
             metadata['file_uri'] = [ root ]
             if metadata.get('identifier'):
+                known = (manifests or {}).get(root)
+                if known and known.get('mtime') == os.stat(root).st_mtime_ns:
+                    metadata['file_manifest'] = known
+                else:
+                    metadata['file_manifest'] = file_manifest(root)
                 records.append(metadata)
     return records;
 
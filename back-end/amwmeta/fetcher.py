@@ -0,0 +1,72 @@
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import requests
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# worth another try
+RETRY_STATUS = (429, 502, 503, 504)
+
+class HostLimitedFetcher:
+    """GET requests with at most per_host at once for each host"""
+    # the failed connections, the timeouts and the RETRY_STATUS
+    # responses are retried with an exponential backoff. The future
+    # raises the last RequestException.
+    def __init__(self, workers=8, per_host=2, timeout=30, retries=2, backoff=1):
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def host_slots(self, url):
+        host = urlparse(url).hostname
+        with self.lock:
+            slots = self.hosts.get(host)
+            if slots is None:
+                slots = threading.BoundedSemaphore(self.per_host)
+                self.hosts[host] = slots
+            return slots
+
+    def session(self):
+        # one per thread, for the keep-alive
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self.local.session = session
+        return session
+
+    def get(self, url, headers={}):
+        return self.executor.submit(self._get, url, headers)
+
+    def _get(self, url, headers):
+        attempt = 0
+        while True:
+            with self.host_slots(url):
+                try:
+                    r = self.session().get(url, headers=headers, timeout=self.timeout)
+                    if r.status_code not in RETRY_STATUS or attempt >= self.retries:
+                        return r
+                    logger.info("GET {0} returned {1}, retrying".format(url, r.status_code))
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    if attempt >= self.retries:
+                        raise
+                    logger.info("GET {0} failed: {1}, retrying".format(url, e))
+            attempt += 1
+            time.sleep(self.backoff * 2 ** (attempt - 1))
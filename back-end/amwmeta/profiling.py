@@ -0,0 +1,114 @@
+from array import array
+from contextlib import contextmanager
+import heapq
+import math
+import time
+
+
+def percentile(ordered, p):
+    # nearest rank
+    if not ordered:
+        return None
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+class IndexProfile:
+    """Time, queries and bytes per entry for each indexing stage"""
+    # queries: callable returning the number of queries run so far
+    def __init__(self, queries=None, keep=20):
+        self.queries = queries
+        self.keep = keep
+        self.timings = {}
+        self.current = {}
+        self.slow = []
+        self.totals = {
+            "entries": 0,
+            "queries": 0,
+            "bytes": 0,
+        }
+        self.started = time.monotonic()
+
+    def __getstate__(self):
+        # sent back from the shard workers, without the callable
+        state = self.__dict__.copy()
+        state['queries'] = None
+        return state
+
+    @contextmanager
+    def stage(self, entry_id, name):
+        queries = self.queries() if self.queries else 0
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            done = self.queries() - queries if self.queries else 0
+            self.add(entry_id, name, time.perf_counter() - started, queries=done)
+
+    def add(self, entry_id, name, seconds, queries=0, size=0):
+        record = self.current.get(entry_id)
+        if record is None:
+            record = { "entry_id": entry_id, "queries": 0, "bytes": 0, "stages": {} }
+            self.current[entry_id] = record
+        record['stages'][name] = record['stages'].get(name, 0) + seconds
+        record['queries'] += queries
+        record['bytes'] += size
+
+    def add_commit(self, seconds):
+        self.timings.setdefault('commit', array('d')).append(seconds)
+
+    def finish(self, entry_id):
+        record = self.current.pop(entry_id, None)
+        if record is None:
+            return
+        for name, seconds in record['stages'].items():
+            self.timings.setdefault(name, array('d')).append(seconds)
+        record['seconds'] = sum(record['stages'].values())
+        self.totals['entries'] += 1
+        self.totals['queries'] += record['queries']
+        self.totals['bytes'] += record['bytes']
+        item = (record['seconds'], entry_id, record)
+        if len(self.slow) < self.keep:
+            heapq.heappush(self.slow, item)
+        else:
+            heapq.heappushpop(self.slow, item)
+
+    def merge(self, other):
+        for name, values in other.timings.items():
+            self.timings.setdefault(name, array('d')).extend(values)
+        for key in self.totals:
+            self.totals[key] += other.totals[key]
+        for item in other.slow:
+            if len(self.slow) < self.keep:
+                heapq.heappush(self.slow, item)
+            else:
+                heapq.heappushpop(self.slow, item)
+
+    def summary(self):
+        stages = {}
+        for name, values in self.timings.items():
+            ordered = sorted(values)
+            stages[name] = {
+                "count": len(ordered),
+                "total": round(sum(ordered), 3),
+                "p50": round(percentile(ordered, 50), 4),
+                "p90": round(percentile(ordered, 90), 4),
+                "p99": round(percentile(ordered, 99), 4),
+                "max": round(ordered[-1], 4),
+            }
+        out = dict(self.totals)
+        out['elapsed'] = round(time.monotonic() - self.started, 3)
+        out['stages'] = stages
+        return out
+
+    def slowest(self):
+        return [ item[2] for item in sorted(self.slow, key=lambda i: i[0], reverse=True) ]
+
+    def report(self):
+        return summary_lines(self.summary())
+
+def summary_lines(summary):
+    lines = [ "Entries: {entries}, queries: {queries}, bytes: {bytes}, elapsed: {elapsed}s".format(**summary) ]
+    for name in ('fetch', 'data', 'terms', 'write', 'commit'):
+        if name in summary['stages']:
+            lines.append("{0:7} total {total}s p50 {p50}s p90 {p90}s p99 {p99}s max {max}s ({count})".format(
+                name, **summary['stages'][name]))
+    return lines
@@ -1,6 +1,15 @@
 import unittest
+import tempfile
 from .harvest import extract_fields
 from .sheets import normalize_records
+from .textstore import TextStore
+from .fetcher import HostLimitedFetcher
+from .profiling import IndexProfile, percentile
+from .calibre import scan_calibre_tree
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import os
+import threading
+import time
 
 
 class HarvestTestCase(unittest.TestCase):
@@ -193,3 +202,118 @@ class HarvestTestCase(unittest.TestCase):
         oai = extract_fields(got, 'pippo.org')
         self.assertEqual(oai['languages'][0], 'it')
         self.assertIn('checksum', oai)
+
+CALIBRE_OPF = """<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+    <dc:identifier opf:scheme="calibre">b0a1</dc:identifier>
+    <dc:title>Test book</dc:title>
+  </metadata>
+</package>
+"""
+
+class CalibreTestCase(unittest.TestCase):
+    def test_manifest(self):
+        with tempfile.TemporaryDirectory() as tree:
+            book = os.path.join(tree, "Author", "Test book (1)")
+            os.makedirs(book)
+            for name, content in (("metadata.opf", CALIBRE_OPF), ("book.pdf", "pdf"), ("book.txt", "text")):
+                with open(os.path.join(book, name), "w") as fh:
+                    fh.write(content)
+            records = scan_calibre_tree(tree)
+            self.assertEqual(len(records), 1)
+            manifest = records[0]['file_manifest']
+            self.assertEqual([ f['ext'] for f in manifest['files'] ], [ '.pdf', '.txt', '.opf' ])
+            self.assertEqual(manifest['files'][0]['size'], 3)
+
+            # unchanged directory, the known manifest is reused
+            records = scan_calibre_tree(tree, manifests={ book: manifest })
+            self.assertIs(records[0]['file_manifest'], manifest)
+
+            os.remove(os.path.join(book, "book.pdf"))
+            os.utime(book, ns=(manifest['mtime'] + 10**9, manifest['mtime'] + 10**9))
+            records = scan_calibre_tree(tree, manifests={ book: manifest })
+            self.assertEqual([ f['name'] for f in records[0]['file_manifest']['files'] ], [ 'book.txt', 'metadata.opf' ])
+
+            # a broken symlink is skipped
+            os.symlink(os.path.join(book, "missing.epub"), os.path.join(book, "book.epub"))
+            records = scan_calibre_tree(tree)
+            self.assertEqual([ f['name'] for f in records[0]['file_manifest']['files'] ], [ 'book.txt', 'metadata.opf' ])
+
+class TextStoreTestCase(unittest.TestCase):
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as root:
+            store = TextStore(root)
+            digest = store.put("<p>Città</p>")
+            self.assertEqual(len(digest), 64)
+            self.assertEqual(store.put("<p>Città</p>"), digest)
+            self.assertEqual(store.get(digest), "<p>Città</p>")
+            self.assertEqual(os.stat(store.path(digest)).st_mode & 0o777, 0o644)
+            self.assertEqual(list(store.digests()), [ digest ])
+            self.assertEqual(list(store.digests(modified_before=time.time() - 60)), [])
+            store.remove(digest)
+            self.assertIsNone(store.get(digest))
+
+class FetcherTestCase(unittest.TestCase):
+    def test_per_host_limit(self):
+        state = { "running": 0, "max": 0, "failures": 1 }
+        lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with lock:
+                    state['running'] += 1
+                    state['max'] = max(state['max'], state['running'])
+                time.sleep(0.05)
+                with lock:
+                    state['running'] -= 1
+                    fail = self.path == '/flaky' and state['failures'] > 0
+                    if fail:
+                        state['failures'] -= 1
+                self.send_response(503 if fail else 200)
+                self.end_headers()
+                self.wfile.write(self.path.encode())
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = "http://127.0.0.1:{}".format(server.server_port)
+        try:
+            with HostLimitedFetcher(workers=6, per_host=2, backoff=0) as fetcher:
+                futures = [ fetcher.get(base + "/" + str(i)) for i in range(6) ]
+                self.assertEqual([ f.result().text for f in futures ],
+                                 [ "/" + str(i) for i in range(6) ])
+                self.assertEqual(state['max'], 2)
+                # retried after the 503
+                self.assertEqual(fetcher.get(base + "/flaky").result().status_code, 200)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class IndexProfileTestCase(unittest.TestCase):
+    def test_profile(self):
+        self.assertEqual(percentile([ 1, 2, 3, 4 ], 50), 2)
+        self.assertEqual(percentile([ 1, 2, 3, 4 ], 99), 4)
+        self.assertIsNone(percentile([], 50))
+        queries = [ 0 ]
+        profile = IndexProfile(queries=lambda: queries[0], keep=2)
+        for entry_id in range(1, 6):
+            with profile.stage(entry_id, 'data'):
+                queries[0] += entry_id
+            profile.add(entry_id, 'terms', entry_id / 100, size=10)
+            profile.finish(entry_id)
+        summary = profile.summary()
+        self.assertEqual(summary['entries'], 5)
+        self.assertEqual(summary['queries'], 15)
+        self.assertEqual(summary['bytes'], 50)
+        self.assertEqual(summary['stages']['terms']['count'], 5)
+        self.assertEqual(summary['stages']['terms']['max'], 0.05)
+        self.assertEqual([ r['entry_id'] for r in profile.slowest() ], [ 5, 4 ])
+
+        other = IndexProfile(keep=2)
+        other.add(9, 'terms', 1)
+        other.finish(9)
+        profile.merge(other)
+        self.assertEqual(profile.summary()['entries'], 6)
+        self.assertEqual([ r['entry_id'] for r in profile.slowest() ], [ 9, 5 ])
@@ -0,0 +1,51 @@
+from pathlib import Path
+import gzip
+import hashlib
+import os
+import tempfile
+
+
+class TextStore:
+    """Content addressed store for the full texts"""
+    # gzipped under the sha256, so identical texts share the file
+    # and an unchanged text is never written again
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def path(self, digest):
+        return self.root.joinpath(digest[:2], digest[2:4], digest + '.gz')
+
+    def put(self, text):
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=path.parent)
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(gzip.compress(data))
+            # mkstemp creates it 0600, the web server could run as
+            # another user
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        return digest
+
+    def get(self, digest):
+        try:
+            return gzip.decompress(self.path(digest).read_bytes()).decode('utf-8')
+        except FileNotFoundError:
+            return None
+
+    def exists(self, digest):
+        return self.path(digest).exists()
+
+    def digests(self, modified_before=None):
+        for path in self.root.glob('*/*/*.gz'):
+            if modified_before is None or path.stat().st_mtime < modified_before:
+                yield path.name[:-len('.gz')]
+
+    def remove(self, digest):
+        try:
+            self.path(digest).unlink()
+        except FileNotFoundError:
+            pass
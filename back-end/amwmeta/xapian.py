@@ -1,11 +1,23 @@
+import base64
+import binascii
+import ctypes
+import errno
+import heapq
 import json
+import os
+import shutil
+import struct
 import sys
+import tempfile
+import threading
+import time
 import xapian
 from sickle import Sickle
 from sickle.oaiexceptions import *
 from urllib.parse import urlparse
 import logging
 from amwmeta.utils import DataPage
+from collections import OrderedDict
 from sickle.models import Record
 import re
 from unidecode import unidecode
@@ -35,11 +47,108 @@ SORTABLE_FIELDS = {
     "datestamp": (9, 'timestamp'),
     "last_modified": (10, 'timestamp'),
 }
+# hash of the indexing record, to skip the unchanged ones
+RECORD_HASH_SLOT = 14
+
+# How the free text is indexed, for each group of fields: fields (the
+# prefixed title), general (title and creators), sources (the
+# original authors and titles of each data source), description,
+# aggregations and full_text. Without positions the phrase searches
+# can't match the field. `unique` indexes a repeated value once.
+INDEX_LAYOUTS = {
+    "full": {
+        "fields":       { "weight": 1,  "positions": True },
+        "general":      { "weight": 20, "positions": True },
+        "sources":      { "weight": 20, "positions": True },
+        "description":  { "weight": 10, "positions": True },
+        "aggregations": { "weight": 20, "positions": True },
+        "full_text":    { "weight": 1,  "positions": True },
+    },
+    "lean": {
+        "fields":       { "weight": 1,  "positions": True },
+        "general":      { "weight": 20, "positions": True },
+        "sources":      { "weight": 20, "positions": True, "unique": True },
+        "description":  { "weight": 10, "positions": True },
+        "aggregations": { "weight": 20, "positions": False },
+        "full_text":    { "weight": 1,  "positions": False },
+    },
+    "metadata": {
+        "fields":       { "weight": 1,  "positions": True },
+        "general":      { "weight": 20, "positions": True },
+        "sources":      { "weight": 20, "positions": True, "unique": True },
+        "description":  { "weight": 10, "positions": True },
+        "aggregations": { "weight": 20, "positions": True },
+        "full_text":    { "index": False },
+    },
+}
+DEFAULT_INDEX_LAYOUT = "full"
+# the layout is stored in the database, so the incremental updates
+# follow the one the index was built with
+INDEX_LAYOUT_KEY = "index_layout"
+
 SORT_DIRECTIONS = {
     "asc": False,
     "desc": True,
 }
 
+def sort_key(value, entry_id):
+    # Order preserving and unique across the documents: the escaped
+    # value, a terminator and the entry id, so the ties are always
+    # broken the same way and a cursor can resume after any document.
+    return value.replace(b"\x00", b"\x00\xff") + b"\x00" + struct.pack('>Q', entry_id)
+
+def encode_cursor(sort_by, sort_dir, key):
+    cursor = "{}:{}:".format(sort_by, int(sort_dir)).encode() + key
+    return base64.urlsafe_b64encode(cursor).decode('ascii')
+
+def decode_cursor(cursor, sort_by, sort_dir):
+    try:
+        decoded = base64.urlsafe_b64decode(cursor.encode('ascii'))
+    except (binascii.Error, UnicodeEncodeError):
+        raise ValueError("Invalid cursor")
+    prefix = "{}:{}:".format(sort_by, int(sort_dir)).encode()
+    if not decoded.startswith(prefix) or len(decoded) < len(prefix) + 9:
+        raise ValueError("Cursor does not match the sorting")
+    key = decoded[len(prefix):]
+    entry_id = struct.unpack('>Q', key[-8:])[0]
+    return (key, entry_id)
+
+# boolean slots hold the ids joined by this, the labels are stored
+# in the database metadata under FACET_LABEL_KEY + prefix + id
+FACET_SEPARATOR = "\x1f"
+FACET_LABEL_KEY = "label:"
+
+# Typeahead: the normalized titles and creators are stored as
+# boolean terms, prefix + P (public) or A (all) + key, so the term
+# dictionary is the prefix structure and the termfreq the ranking.
+# The labels live in the metadata, like the facet ones, under the A
+# prefix.
+SUGGEST_FIELDS = {
+    'title': 'XZT',
+    'creator': 'XZA',
+}
+SUGGEST_MAX_LENGTH = 200
+SUGGEST_MIN_LENGTH = 2
+# completions ranked for each one returned, as some may be hidden
+SUGGEST_CANDIDATES = 3
+# upper bound on the documents checked against the active libraries
+SUGGEST_CHECK_LIMIT = 1000
+
+def suggest_key(text):
+    return re.sub(r'\s+', ' ', unidecode(text).lower()).strip()[0:SUGGEST_MAX_LENGTH]
+
+# exact: visit every match so the spies count everything
+# sampled: stop after checkatleast matches and scale the counts
+# none: no facets at all
+FACET_MODES = ('exact', 'sampled', 'none')
+
+# full: a page of matches and the facets
+# matches: a page of matches, no spies (paging with the facets shown)
+# facets: only the facets, no document is retrieved
+# count: only the estimated number of matches, no spies
+RESULT_MODES = ('full', 'matches', 'facets', 'count')
+DEFAULT_CHECKATLEAST = 10000
+
 # XH is unique source
 EXCLUSION_FIELDS = {
     'library': 'XH',
@@ -47,11 +156,492 @@ EXCLUSION_FIELDS = {
     'entry': 'Q',
 }
 
+# a sharded index is a directory holding shard-0, shard-1, ...
+SHARD_PREFIX = "shard-"
+
+def shard_path(db_path, shard):
+    return os.path.join(db_path, SHARD_PREFIX + str(shard))
+
+def index_shards(db_path):
+    # an empty list for a plain database
+    try:
+        names = [ n for n in os.listdir(db_path) if n.startswith(SHARD_PREFIX) ]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+    names.sort(key=lambda n: int(n[len(SHARD_PREFIX):]))
+    return [ os.path.join(db_path, n) for n in names ]
+
+def merge_shards(shards, destination):
+    db = xapian.Database()
+    for path in shards:
+        db.add_database(xapian.Database(path))
+    db.compact(destination, xapian.DBCOMPACT_MULTIPASS)
+    db.close()
+
+def open_index(db_path):
+    # read-only, sharded or not
+    shards = index_shards(db_path)
+    if not shards:
+        return xapian.Database(db_path)
+    db = xapian.Database()
+    for path in shards:
+        db.add_database(xapian.Database(path))
+    return db
+
+def index_revisions(db_path):
+    # one for each shard
+    revisions = []
+    for path in index_shards(db_path) or [ db_path ]:
+        db = xapian.Database(path)
+        revisions.append(db.get_revision())
+        db.close()
+    return revisions
+
+def index_size(db_path):
+    # following the generation symlink
+    total = 0
+    for root, dirs, files in os.walk(os.path.realpath(db_path)):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+def index_prefixes():
+    # term prefix => description, longest first so XZTA wins over X...
+    prefixes = { FIELD_MAPPING[f][1]: f for f in FIELD_MAPPING }
+    for field, prefix in SUGGEST_FIELDS.items():
+        prefixes[prefix + 'A'] = "suggest " + field
+        prefixes[prefix + 'P'] = "suggest " + field + " (public)"
+    prefixes['Q'] = "entry id"
+    prefixes['P'] = "public"
+    return OrderedDict(sorted(prefixes.items(), key=lambda p: (-len(p[0]), p[0])))
+
+def index_stats(db_path):
+    # the free text terms have no prefix, the term generator
+    # lowercases them
+    db = open_index(db_path)
+    prefixes = index_prefixes()
+    terms = OrderedDict((p, { "name": name, "terms": 0, "postings": 0 }) for p, name in prefixes.items())
+    terms[""] = { "name": "free text", "terms": 0, "postings": 0 }
+    encoded = [ (p, p.encode()) for p in prefixes ]
+    for item in db.allterms():
+        found = ""
+        for prefix, bprefix in encoded:
+            if item.term.startswith(bprefix):
+                found = prefix
+                break
+        terms[found]['terms'] += 1
+        terms[found]['postings'] += item.termfreq
+    stats = {
+        "path": os.path.realpath(db_path),
+        "shards": len(index_shards(db_path)),
+        "documents": db.get_doccount(),
+        "last_docid": db.get_lastdocid(),
+        "average_length": db.get_avlength(),
+        "index_layout": db.get_metadata(INDEX_LAYOUT_KEY).decode() or DEFAULT_INDEX_LAYOUT,
+        "size": index_size(db_path),
+        "terms": terms,
+    }
+    db.close()
+    return stats
+
+def merge_shard_labels(shards):
+    # a multi-shard database reads the metadata from the first shard
+    # only, so copy the facet labels there when serving from shards.
+    first = xapian.WritableDatabase(shards[0], xapian.DB_OPEN)
+    for path in shards[1:]:
+        db = xapian.Database(path)
+        for key in db.metadata_keys(FACET_LABEL_KEY):
+            first.set_metadata(key, db.get_metadata(key))
+        db.close()
+    first.commit()
+    first.close()
+
+# Rebuilds are written into a new generation directory next to the
+# index, and db_path becomes a symlink to the active one. The
+# directories still being built carry the staging suffix.
+GENERATIONS_SUFFIX = ".generations"
+STAGING_SUFFIX = ".staging"
+
+def generations_path(db_path):
+    return db_path + GENERATIONS_SUFFIX
+
+def index_generations(db_path):
+    # oldest first, without the staging ones
+    base = generations_path(db_path)
+    try:
+        names = sorted([ n for n in os.listdir(base) if not n.endswith(STAGING_SUFFIX) ])
+    except FileNotFoundError:
+        return []
+    return [ os.path.join(base, n) for n in names ]
+
+def current_generation(db_path):
+    if os.path.islink(db_path):
+        return os.path.realpath(db_path)
+    return None
+
+def new_generation(db_path):
+    # the staging directory of a rebuild, named so that the
+    # generations sort by creation time
+    base = generations_path(db_path)
+    os.makedirs(base, exist_ok=True)
+    now = time.time()
+    prefix = time.strftime("%Y%m%d%H%M%S", time.gmtime(now)) + "{:06d}-".format(int(now % 1 * 1000000))
+    return tempfile.mkdtemp(prefix=prefix, suffix=STAGING_SUFFIX, dir=base)
+
+def exchange_paths(first, second):
+    # atomic swap with renameat2(RENAME_EXCHANGE), False if the
+    # platform or the filesystem can't do it
+    renameat2 = getattr(ctypes.CDLL(None, use_errno=True), 'renameat2', None)
+    if renameat2 is None:
+        return False
+    AT_FDCWD = -100
+    RENAME_EXCHANGE = 2
+    if renameat2(AT_FDCWD, os.fsencode(first), AT_FDCWD, os.fsencode(second), RENAME_EXCHANGE) == 0:
+        return True
+    if ctypes.get_errno() in (errno.EINVAL, errno.ENOSYS):
+        return False
+    raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), second)
+
+def activate_generation(db_path, path):
+    # the readers pick the new generation up on their next refresh
+    if path.endswith(STAGING_SUFFIX):
+        final = path[:-len(STAGING_SUFFIX)]
+        os.rename(path, final)
+        path = final
+    swap = db_path + ".swap"
+    if os.path.lexists(swap):
+        os.unlink(swap)
+    os.symlink(os.path.relpath(path, os.path.dirname(db_path)), swap)
+    if os.path.isdir(db_path) and not os.path.islink(db_path):
+        # first swap: the plain directory becomes the oldest generation.
+        # A symlink can't replace a directory, exchange them instead.
+        legacy = os.path.join(generations_path(db_path), "00000000000000000000-legacy")
+        if exchange_paths(swap, db_path):
+            os.rename(swap, legacy)
+        else:
+            # db_path is missing until the replace below
+            os.rename(db_path, legacy)
+    if os.path.lexists(swap):
+        # atomic
+        os.replace(swap, db_path)
+    logger.info("{} now points to {}".format(db_path, path))
+    return path
+
+def prune_generations(db_path, keep):
+    # the active one is kept in any case
+    current = current_generation(db_path)
+    generations = index_generations(db_path)
+    removed = []
+    for path in generations[:max(len(generations) - keep, 0)]:
+        if os.path.realpath(path) != current:
+            shutil.rmtree(path)
+            removed.append(path)
+    return removed
+
+def rollback_generation(db_path):
+    current = current_generation(db_path)
+    generations = index_generations(db_path)
+    for i, path in enumerate(generations):
+        if os.path.realpath(path) == current and i > 0:
+            return activate_generation(db_path, generations[i - 1])
+    raise ValueError("No previous generation for " + db_path)
+
+class MycorrhizaSearcher:
+    # reopened only when the revision on disk changes. Use
+    # get_searcher(), which keeps one per process and thread.
+    # the backend rewrites this file on every commit
+    VERSION_FILES = ('iamglass', 'iamhoney', 'iamchert')
+    MAX_COMPILED_EXCLUSIONS = 256
+
+    def __init__(self, db_path):
+        logger.debug("Opening searcher on " + db_path)
+        self.db_path = db_path
+        # take the stamp before opening, so a commit in between
+        # triggers a reopen on the next refresh
+        self.stamp = self.disk_stamp()
+        self.open()
+        self.queryparser = xapian.QueryParser()
+        self.queryparser.set_stemmer(xapian.Stem("none"))
+        self.queryparser.set_stemming_strategy(self.queryparser.STEM_NONE)
+        for field in FIELD_MAPPING:
+            if FIELD_MAPPING[field][2]:
+                self.queryparser.add_boolean_prefix(field, FIELD_MAPPING[field][1])
+            else:
+                self.queryparser.add_prefix(field, FIELD_MAPPING[field][1])
+        self.queryparser.set_database(self.db)
+        self.labels = {}
+        self.exclusions = OrderedDict()
+
+    def open(self):
+        shards = index_shards(self.db_path)
+        if shards:
+            self.shards = [ xapian.Database(path) for path in shards ]
+            self.db = xapian.Database()
+            for shard in self.shards:
+                self.db.add_database(shard)
+        else:
+            self.shards = []
+            self.db = xapian.Database(self.db_path)
+
+    def version_stamp(self, path):
+        for name in self.VERSION_FILES:
+            try:
+                st = os.stat(os.path.join(path, name))
+                return (st.st_ino, st.st_mtime_ns, st.st_size)
+            except FileNotFoundError:
+                pass
+        return None
+
+    def disk_stamp(self):
+        # the inode of the directory changes when the index is swapped
+        # with a rebuilt one
+        try:
+            st = os.stat(self.db_path)
+        except FileNotFoundError:
+            return None
+        paths = index_shards(self.db_path) or [ self.db_path ]
+        return (st.st_ino,) + tuple(self.version_stamp(path) for path in paths)
+
+    def revision(self):
+        # a multi-shard database has no single revision
+        if self.shards:
+            return ":".join([ str(shard.get_revision()) for shard in self.shards ])
+        return self.db.get_revision()
+
+    def facet_label(self, prefix, facet_id):
+        # cached until the next reopen
+        key = prefix + facet_id
+        label = self.labels.get(key)
+        if label is None:
+            label = self.db.get_metadata(FACET_LABEL_KEY + key).decode('utf-8') or facet_id
+            self.labels[key] = label
+        return label
+
+    def compile_exclusions(self, exclusions):
+        # the users keep the same exclusions across searches, so keep
+        # the recent compiled queries around. They don't depend on
+        # the revision.
+        key = tuple(sorted(exclusions))
+        compiled = self.exclusions.get(key)
+        if compiled is None:
+            excluded_libraries = { i[1]: True for i in key if i[0] == 'library' }
+            excluded = [ xapian.Query(EXCLUSION_FIELDS[q[0]] + str(q[1])) for q in key ]
+            compiled = (xapian.Query(xapian.Query.OP_OR, excluded), excluded_libraries)
+            self.exclusions[key] = compiled
+            if len(self.exclusions) > self.MAX_COMPILED_EXCLUSIONS:
+                self.exclusions.popitem(last=False)
+        else:
+            self.exclusions.move_to_end(key)
+        return compiled
+
+    def refresh(self):
+        if self.disk_stamp() != self.stamp:
+            self.reopen()
+
+    def reopen(self):
+        stamp = self.disk_stamp()
+        replaced = (stamp is None or self.stamp is None
+                    or stamp[0] != self.stamp[0] or len(stamp) != len(self.stamp))
+        if not replaced:
+            try:
+                self.db.reopen()
+            except xapian.DatabaseError:
+                # the directory was replaced (e.g. harvest --force)
+                replaced = True
+        if replaced:
+            logger.info("Reopening {} from scratch".format(self.db_path))
+            self.open()
+            self.queryparser.set_database(self.db)
+        self.labels = {}
+        self.stamp = stamp
+
+def facet_id(raw):
+    # ids are integers (agents, libraries, years) or codes
+    if raw.isdigit():
+        return int(raw)
+    return raw
+
+_searchers = threading.local()
+
+def get_searcher(db_path):
+    pid = os.getpid()
+    if getattr(_searchers, 'pid', None) != pid:
+        # new thread or forked worker: never reuse the parent handles
+        _searchers.pid = pid
+        _searchers.handles = {}
+    searcher = _searchers.handles.get(db_path)
+    if searcher is None:
+        searcher = MycorrhizaSearcher(db_path)
+        _searchers.handles[db_path] = searcher
+    else:
+        searcher.refresh()
+    return searcher
+
 def search(db_path, query_params,
            active_libraries=[],
            exclusions=[],
-           matches_only=False):
-    db = xapian.Database(db_path)
+           matches_only=False,
+           facet_mode='exact',
+           checkatleast=DEFAULT_CHECKATLEAST,
+           raw_matches=False,
+           result='full'):
+    # with raw_matches the matches are JSON bytes, ready to be
+    # spliced into the response, see matches_json()
+    searcher = get_searcher(db_path)
+    options = {
+        "active_libraries": active_libraries,
+        "exclusions": exclusions,
+        "matches_only": matches_only,
+        "facet_mode": facet_mode,
+        "checkatleast": checkatleast,
+        "raw_matches": raw_matches,
+        "result": result,
+    }
+    try:
+        return _search(searcher, query_params, **options)
+    except xapian.DatabaseModifiedError:
+        # a writer committed too many revisions while we were
+        # reading, reopen and retry once
+        logger.info("Database modified while searching, retrying")
+        searcher.reopen()
+        return _search(searcher, query_params, **options)
+
+def suggest(db_path, text, public_only=True, limit=10, active_libraries=None):
+    searcher = get_searcher(db_path)
+    try:
+        return _suggest(searcher, text, public_only, limit, active_libraries)
+    except xapian.DatabaseModifiedError:
+        searcher.reopen()
+        return _suggest(searcher, text, public_only, limit, active_libraries)
+
+def _suggest(searcher, text, public_only, limit, active_libraries):
+    key = suggest_key(text)
+    if len(key) < SUGGEST_MIN_LENGTH:
+        return []
+    families = OrderedDict()
+    for field, prefix in SUGGEST_FIELDS.items():
+        families[prefix + ('P' if public_only else 'A')] = field
+
+    def completions():
+        for family in families:
+            for item in searcher.db.allterms(family + key):
+                yield (item.termfreq, item.term.decode('utf-8'))
+
+    size = limit
+    if active_libraries is not None:
+        size = limit * SUGGEST_CANDIDATES
+    # the most frequent ones, whatever their position in the term list
+    candidates = { term: count for count, term in heapq.nlargest(size, completions()) }
+
+    if active_libraries is not None and candidates:
+        # same filter of the search, so a suggestion never leads to an
+        # empty result. The count becomes the one of the visible
+        # documents, found with a single query.
+        library_filter = xapian.Query(xapian.Query.OP_OR,
+                                      [ xapian.Query('XH{}'.format(i)) for i in active_libraries ])
+        enquire = xapian.Enquire(searcher.db)
+        enquire.set_query(xapian.Query(xapian.Query.OP_FILTER,
+                                       xapian.Query(xapian.Query.OP_OR, [ xapian.Query(t) for t in candidates ]),
+                                       library_filter))
+        mset = enquire.get_mset(0, SUGGEST_CHECK_LIMIT)
+        visible = dict.fromkeys(candidates, 0)
+        for match in mset:
+            for term in enquire.matching_terms(match):
+                visible[term.decode('utf-8')] += 1
+        scale = 1
+        if mset.size() and mset.size() < mset.get_matches_estimated():
+            # too many documents, scale the counts of the sample
+            scale = mset.get_matches_estimated() / mset.size()
+        candidates = { term: max(1, round(count * scale)) for term, count in visible.items() if count }
+
+    out = []
+    for term, count in sorted(candidates.items(), key=lambda c: (-c[1], c[0]))[0:limit]:
+        family = next(f for f in families if term.startswith(f))
+        field = families[family]
+        out.append({
+            "type": field,
+            "value": searcher.facet_label(SUGGEST_FIELDS[field] + 'A', term[len(family):]),
+            "count": count,
+        })
+    return out
+
+def search_all(db_path, query_params, chunk_size=500, **options):
+    # Generator over every match, as raw JSON hits. It walks the
+    # results with the cursors, so each chunk costs the same and the
+    # walk survives commits in between.
+    params = query_params.copy()
+    if not SORTABLE_FIELDS.get(params.get('sort_by')):
+        params['sort_by'] = 'datestamp'
+        params['sort_direction'] = 'asc'
+    params['page_size'] = chunk_size
+    params.pop('page_number', None)
+    options['raw_matches'] = True
+    options['facet_mode'] = 'none'
+    while True:
+        res = search(db_path, params, **options)
+        for match in res['matches']:
+            yield match
+        if not res['next_cursor']:
+            break
+        params['cursor'] = res['next_cursor']
+
+def hit_data(record):
+    # The document data is the search hit, already serialized. The
+    # first line is the entry without the data sources, then a line
+    # for each data source, prefixed by library id and public flag,
+    # so the search can filter them without decoding anything.
+    # json.dumps escapes the newlines.
+    head = {}
+    for field in record:
+        values = record.get(field)
+        if values and field != 'data_sources':
+            if field == "identifier":
+                urls = [ i for i in values if re.match(r'^https?://', i) ]
+                if len(urls):
+                    head['url'] = urls[0]
+                    head['identifiers'] = values
+            else:
+                head[field] = values
+    lines = [ json.dumps(head) ]
+    for ds in record['data_sources']:
+        lines.append("{} {} {}".format(ds['library_id'], 1 if ds['public'] else 0, json.dumps(ds)))
+    return "\n".join(lines)
+
+def render_hit(data, active_libraries, excluded_libraries):
+    lines = data.split(b"\n")
+    head = lines[0]
+    data_sources = []
+    for line in lines[1:]:
+        library_id, public, fragment = line.split(b" ", 2)
+        library_id = int(library_id)
+        if active_libraries:
+            visible = library_id in active_libraries
+        else:
+            visible = public == b"1"
+        if visible and not excluded_libraries.get(library_id):
+            data_sources.append(fragment)
+    if head != b"{}":
+        head = head[:-1] + b", "
+    else:
+        head = b"{"
+    return head + b'"data_sources": [' + b", ".join(data_sources) + b"]}"
+
+def matches_json(matches):
+    return b"[" + b", ".join(matches) + b"]"
+
+def _search(searcher, query_params, active_libraries=[], exclusions=[],
+            matches_only=False, facet_mode='exact', checkatleast=DEFAULT_CHECKATLEAST,
+            raw_matches=False, result='full'):
+    if facet_mode not in FACET_MODES:
+        raise ValueError("Invalid facet mode " + str(facet_mode))
+    if result not in RESULT_MODES:
+        raise ValueError("Invalid result mode " + str(result))
+    if matches_only or result in ('matches', 'count'):
+        # nobody is going to look at the counts
+        facet_mode = 'none'
+
+    db = searcher.db
+    queryparser = searcher.queryparser
     querystring = query_params.get("query")
 
     # todo setup validation in the views.py
@@ -63,17 +653,10 @@ def search(db_path, query_params,
     if page_number < 1:
         page_number = 1
 
-    queryparser = xapian.QueryParser()
-    queryparser.set_stemmer(xapian.Stem("none"))
-    queryparser.set_stemming_strategy(queryparser.STEM_NONE)
-
-    for field in FIELD_MAPPING:
-        if FIELD_MAPPING[field][2]:
-            queryparser.add_boolean_prefix(field, FIELD_MAPPING[field][1])
-        else:
-            queryparser.add_prefix(field, FIELD_MAPPING[field][1])
-
-    excluded_libraries = { i[1]: True for i in exclusions if i[0] == 'library' }
+    excluded_query = None
+    excluded_libraries = {}
+    if exclusions:
+        excluded_query, excluded_libraries = searcher.compile_exclusions(exclusions)
     logger.debug("Excluded libraries: {}".format(excluded_libraries))
 
     context = {}
@@ -116,16 +699,21 @@ def search(db_path, query_params,
                              xapian.Query(xapian.Query.OP_AND, filter_queries))
 
     # blacklist
-    if exclusions:
-        excluded = [ xapian.Query(EXCLUSION_FIELDS[q[0]] + str(q[1])) for q in exclusions ]
+    if excluded_query is not None:
         query = xapian.Query(xapian.Query.OP_AND_NOT,
                              query,
-                             xapian.Query(xapian.Query.OP_OR, excluded))
+                             excluded_query)
 
     enquire = xapian.Enquire(db)
     logger.debug(query)
     enquire.set_query(query)
 
+    sort_by = None
+    sort_dir = None
+    cursor = None
+    if result in ('full', 'matches'):
+        # no paging for the facets and the count
+        cursor = query_params.get('cursor')
     if SORTABLE_FIELDS.get(query_params.get('sort_by')):
         sort_by = SORTABLE_FIELDS.get(query_params.get('sort_by', ''), SORTABLE_FIELDS['title'])[0]
         sort_dir = SORT_DIRECTIONS.get(query_params.get('sort_direction', ''), SORT_DIRECTIONS['asc'])
@@ -133,67 +721,109 @@ def search(db_path, query_params,
         enquire.set_sort_by_value_then_relevance(sort_by, sort_dir)
     # otherwise keep the default ordering, decreasing relevance score
 
+    if cursor and sort_by is not None:
+        # resume after the last document of the previous page: the
+        # sort keys are unique, so restrict the query to the range
+        # starting at the cursor and drop the cursor document itself.
+        cursor_key, cursor_entry = decode_cursor(cursor, sort_by, sort_dir)
+        if sort_dir:
+            cursor_range = xapian.Query(xapian.Query.OP_VALUE_LE, sort_by, cursor_key)
+        else:
+            cursor_range = xapian.Query(xapian.Query.OP_VALUE_GE, sort_by, cursor_key)
+        query = xapian.Query(xapian.Query.OP_AND_NOT,
+                             xapian.Query(xapian.Query.OP_FILTER, query, cursor_range),
+                             xapian.Query("Q{}".format(cursor_entry)))
+        enquire.set_query(query)
+        page_number = 1
+    elif cursor:
+        raise ValueError("A cursor needs a sortable field")
+
+    if result == 'count':
+        mset = enquire.get_mset(0, 0)
+        return {
+            "querystring": querystring,
+            "filters": active_facets,
+            "total_entries": mset.get_matches_estimated(),
+            "lower_bound": mset.get_matches_lower_bound(),
+            "upper_bound": mset.get_matches_upper_bound(),
+        }
+    elif result == 'facets':
+        # let the spies run, but retrieve nothing
+        page_number = 1
+        page_size = 0
+
 
     matches = []
     facets = {}
-    for field in FIELD_MAPPING:
-        # boolean only
-        if FIELD_MAPPING[field][2]:
-            # use the slot
-            spy = xapian.ValueCountMatchSpy(FIELD_MAPPING[field][0])
-            enquire.add_matchspy(spy)
-            spies[field] = spy
+    if facet_mode != 'none':
+        for field in FIELD_MAPPING:
+            # boolean only
+            if FIELD_MAPPING[field][2]:
+                # use the slot
+                spy = xapian.ValueCountMatchSpy(FIELD_MAPPING[field][0])
+                enquire.add_matchspy(spy)
+                spies[field] = spy
 
-    start = (page_number - 1) * page_size
-    mset = enquire.get_mset(start, page_size, db.get_doccount())
-    pager = DataPage(total_entries=mset.get_matches_estimated(),
-                     entries_per_page=page_size,
-                     current_page=page_number)
-    logger.info(pager)
+    if facet_mode == 'exact':
+        checkatleast = db.get_doccount()
+    elif facet_mode == 'none':
+        checkatleast = 0
 
-    for match in mset:
-        fields = json.loads(match.document.get_data().decode('utf8'))
-        rec = {}
-        for field in fields:
-            values = fields.get(field)
-            if values:
-                if field == "identifier":
-                    urls = [ i for i in values if re.match(r'^https?://', i) ]
-                    if len(urls):
-                        rec['url'] = urls[0]
-                        rec['identifiers'] = values
-                else:
-                    rec[field] = values
+    start = (page_number - 1) * page_size
+    mset = enquire.get_mset(start, page_size, checkatleast)
+    pager = None
+    if result in ('full', 'matches'):
+        pager = DataPage(total_entries=mset.get_matches_estimated(),
+                         entries_per_page=page_size,
+                         current_page=page_number)
+        logger.info(pager)
 
-        # logger.info(rec)
+    facet_scale = 1
+    if facet_mode == 'sampled' and spies:
+        seen = next(iter(spies.values())).get_total()
+        if seen and seen < mset.get_matches_estimated():
+            facet_scale = mset.get_matches_estimated() / seen
+            logger.debug("Facets sampled on {} documents, scaling by {}".format(seen, facet_scale))
+        else:
+            # everything was visited anyway
+            facet_mode = 'exact'
 
-        # if there are excluded sites, also remove them from here.
-        # Sole source are already filtered out.
+    # if there are excluded sites, also remove them from here.
+    # Sole source are already filtered out.
 
-        # TODO There the case where the other one is private and does
-        # not show up. In that case it will have no link and no
-        # reference. So it's not showing up because it's excluded,
-        # while the other is private, so it's not seen as an unique
-        # source
+    # TODO There the case where the other one is private and does
+    # not show up. In that case it will have no link and no
+    # reference. So it's not showing up because it's excluded,
+    # while the other is private, so it's not seen as an unique
+    # source
 
-        if active_libraries:
-            rec['data_sources'] = [ ds for ds in rec['data_sources'] if ds['library_id'] in active_libraries ]
+    visible_libraries = set(active_libraries)
+    last_document = None
+    for match in mset:
+        last_document = match.document
+        hit = render_hit(last_document.get_data(), visible_libraries, excluded_libraries)
+        if raw_matches:
+            matches.append(hit)
         else:
-            rec['data_sources'] = [ ds for ds in rec['data_sources'] if ds['public'] ]
-        if exclusions:
-            rec['data_sources'] = [ ds for ds in rec['data_sources'] if not excluded_libraries.get(ds['library_id']) ]
-        matches.append(rec)
+            matches.append(json.loads(hit))
+
+    next_cursor = None
+    if sort_by is not None and page_size and mset.size() == page_size:
+        next_cursor = encode_cursor(sort_by, sort_dir, last_document.get_value(sort_by))
 
     if matches_only:
         return matches
 
+    context['next_cursor'] = next_cursor
+
     for spy_name in spies:
         spy = spies[spy_name]
+        prefix = FIELD_MAPPING[spy_name][1]
         facet_values = {}
         for facet in spy.values():
             # logger.debug(facet.term)
-            for facet_structure in json.loads(facet.term.decode('utf-8')):
-                facet_value = facet_structure['value']
+            for raw_id in facet.term.decode('utf-8').split(FACET_SEPARATOR):
+                facet_value = searcher.facet_label(prefix, raw_id)
                 facet_active = False
                 if facet_value in active_facets[spy_name]:
                     facet_active = True
@@ -202,13 +832,17 @@ def search(db_path, query_params,
                     facet_values[facet_value]['count'] += facet.termfreq
                 else:
                     facet_values[facet_value] = {
-                        "id": facet_structure['id'],
-                        "term": str(facet_value),
+                        "id": facet_id(raw_id),
+                        "term": facet_value,
                         "count": facet.termfreq,
                         "active": facet_active,
-                        "key": spy_name + str(facet_structure['id']),
+                        "key": spy_name + raw_id,
                     }
 
+        if facet_scale != 1:
+            for v in facet_values.values():
+                v['count'] = max(1, round(v['count'] * facet_scale))
+
         if len(facet_values):
             facets[spy_name] = {
                 "name": spy_name,
@@ -225,25 +859,174 @@ def search(db_path, query_params,
         facets['library']['values'] = [ v for v in facets['library']['values'] if not excluded_libraries.get(v['id']) ]
 
     context['facets'] = facets
+    context['facet_mode'] = facet_mode
     context['filters'] = active_facets
-    context['pager'] = pager
     context['querystring'] = querystring
+    if result == 'facets':
+        context['total_entries'] = mset.get_matches_estimated()
+        del context['matches']
+        del context['next_cursor']
+    else:
+        context['pager'] = pager
 
     return context
 
 class MycorrhizaIndexer:
+    # use it as a context manager: batch_size documents for each
+    # transaction, the pending one is cancelled on errors, and on_commit
+    # gets the entries of each committed batch
+
     # kw only argument
-    def __init__(self, *, db_path):
+    def __init__(self, *, db_path, batch_size=1000, profile=None, force=False, index_layout=None,
+                 on_commit=None):
         logger.debug("Initializing MycorrhizaIndexer with " + db_path)
-        self.db = xapian.WritableDatabase(db_path, xapian.DB_CREATE_OR_OPEN)
+        if index_layout and index_layout not in INDEX_LAYOUTS:
+            raise ValueError("Invalid index layout " + index_layout)
+        shards = index_shards(db_path)
+        if shards:
+            self.dbs = [ xapian.WritableDatabase(path, xapian.DB_OPEN) for path in shards ]
+        else:
+            self.dbs = [ xapian.WritableDatabase(db_path, xapian.DB_CREATE_OR_OPEN) ]
+        # the metadata goes to the first shard
+        self.db = self.dbs[0]
         self.logs = []
+        self.labels = {}
+        self.batch_size = batch_size
+        self.profile = profile
+        self.force = force
+        self.on_commit = on_commit
+        self.committing = []
+        if index_layout:
+            self.db.set_metadata(INDEX_LAYOUT_KEY, index_layout)
+        else:
+            index_layout = self.db.get_metadata(INDEX_LAYOUT_KEY).decode() or DEFAULT_INDEX_LAYOUT
+        self.index_layout = index_layout
+        self.index_fields = INDEX_LAYOUTS[index_layout]
+        self.in_transaction = False
+        self.pending = 0
+        self.counters = {
+            "written": 0,
+            "deleted": 0,
+            "skipped": 0,
+            "unchanged": 0,
+            "commits": 0,
+        }
+
+    def __enter__(self):
+        self.begin()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                logger.info("Indexing failed, cancelling the pending batch")
+                self.rollback()
+        finally:
+            self.close()
+        return False
+
+    def begin(self):
+        if not self.in_transaction:
+            # unflushed: commit() does the flushing
+            for db in self.dbs:
+                db.begin_transaction(False)
+            self.in_transaction = True
+
+    def commit(self):
+        started = time.perf_counter()
+        for db in self.dbs:
+            if self.in_transaction:
+                db.commit_transaction()
+            db.commit()
+        if self.on_commit and self.committing:
+            self.on_commit(self.committing)
+        self.committing = []
+        if self.profile:
+            self.profile.add_commit(time.perf_counter() - started)
+        self.in_transaction = False
+        self.counters['commits'] += 1
+        self.pending = 0
+
+    def rollback(self):
+        if self.in_transaction:
+            for db in self.dbs:
+                db.cancel_transaction()
+            self.in_transaction = False
+        self.pending = 0
+        # the labels set in the batch are gone as well
+        self.labels = {}
+        self.committing = []
+
+    def close(self):
+        for db in self.dbs:
+            db.close()
+
+    def skip(self):
+        self.counters['skipped'] += 1
+
+    def summary(self):
+        return "Written: {written}, deleted: {deleted}, skipped: {skipped}, unchanged: {unchanged}, commits: {commits}".format(**self.counters)
+
+    def _count(self, counter):
+        self.counters[counter] += 1
+        self.pending += 1
+        if self.in_transaction and self.pending >= self.batch_size:
+            self.commit()
+            self.begin()
 
     def index_entries(self, entries):
         for e in entries:
             logger.debug("Xapian indexing {}".format(e.id))
-            self.index_record(e.indexing_data())
+            if self.profile:
+                with self.profile.stage(e.id, 'data'):
+                    record = e.indexing_data()
+            else:
+                record = e.indexing_data()
+            if self.on_commit:
+                # before index_record(), which can trigger the commit
+                self.committing.append(e)
+            self.index_record(record)
+
+    def set_facet_label(self, prefix, value):
+        key = prefix + str(value['id'])
+        label = str(value['value'])
+        if self.labels.get(key) != label:
+            self.db.set_metadata(FACET_LABEL_KEY + key, label)
+            self.labels[key] = label
+
+    def index_text(self, termgenerator, group, text, prefix=""):
+        conf = self.index_fields[group]
+        if not conf.get('index', True):
+            return False
+        if conf['positions']:
+            termgenerator.index_text(text, conf['weight'], prefix)
+        else:
+            termgenerator.index_text_without_positions(text, conf['weight'], prefix)
+        return True
+
+    def stored_hash(self, identifier):
+        db = self.dbs[identifier % len(self.dbs)]
+        for posting in db.postlist("Q{}".format(identifier)):
+            return db.get_document(posting.docid).get_value(RECORD_HASH_SLOT).decode()
+        return None
+
+    def delete_entry(self, identifier):
+        idterm = "Q{}".format(identifier)
+        self.logs.append("Removing document " + idterm)
+        self.dbs[identifier % len(self.dbs)].delete_document(idterm)
+        self._count('deleted')
 
     def index_record(self, record):
+        started = time.perf_counter()
+        record_hash = record.pop('record_hash', None)
+        if record_hash and not self.force and self.stored_hash(record['entry_id']) == record_hash:
+            logger.debug("Entry {} is unchanged".format(record['entry_id']))
+            self.counters['unchanged'] += 1
+            if self.profile:
+                self.profile.finish(record['entry_id'])
+            return
         is_deleted = True
         termgenerator = xapian.TermGenerator()
         termgenerator.set_stemmer(xapian.Stem("none"))
@@ -274,26 +1057,47 @@ class MycorrhizaIndexer:
                             # logger.debug("Adding boolean {}".format(prefix + str(v['id'])))
                             doc.add_boolean_term(prefix + str(v['id']))
                         else:
-                            termgenerator.index_text(str(v['value']), 1, prefix)
+                            self.index_text(termgenerator, 'fields', str(v['value']), prefix)
                         value_list.append(v)
 
-                doc.add_value(slot, json.dumps(value_list))
+                if is_boolean:
+                    doc.add_value(slot, FACET_SEPARATOR.join([ str(v['id']) for v in value_list ]))
+                    for v in value_list:
+                        self.set_facet_label(prefix, v)
+                else:
+                    doc.add_value(slot, json.dumps(value_list))
 
         for field in SORTABLE_FIELDS:
             slot, sort_type = SORTABLE_FIELDS[field]
             sort_value = record.get(field)
             # print("Sort value for {} is {}".format(field, sort_value))
+            # always set, so the cursors can walk over every document
+            value = b""
             if sort_value is not None and len(sort_value) > 0:
                 # print(sort_value)
                 if sort_type == 'number':
-                    doc.add_value(slot, xapian.sortable_serialise(sort_value[0]['value']))
+                    value = xapian.sortable_serialise(sort_value[0]['value'])
                 elif sort_type == 'timestamp':
                     logger.info("Adding {} {} for {}".format(slot, sort_value, identifier))
-                    doc.add_value(slot, sort_value)
+                    value = sort_value.encode()
                 elif sort_type == 'string':
                     stripped = unidecode(' '.join([ v['value'] for v in sort_value ])).lower()
                     stripped = re.sub(r'^[^a-z0-9]+', '', stripped)
-                    doc.add_value(slot, stripped)
+                    value = stripped.encode()
+            doc.add_value(slot, sort_key(value, identifier))
+
+        for field, prefix in SUGGEST_FIELDS.items():
+            values = record.get(field) or []
+            if field == 'title':
+                # not the subtitle
+                values = values[0:1]
+            for v in values:
+                key = suggest_key(str(v['value']))
+                if len(key) >= SUGGEST_MIN_LENGTH:
+                    doc.add_boolean_term(prefix + 'A' + key)
+                    if record['public']:
+                        doc.add_boolean_term(prefix + 'P' + key)
+                    self.set_facet_label(prefix + 'A', { "id": key, "value": v['value'] })
 
         # general search
         for field in ['title', 'creator']:
@@ -301,7 +1105,7 @@ class MycorrhizaIndexer:
             values = record.get(field)
             for v in values:
                 # logger.debug("Indexing {} {}".format(field, v['value']))
-                termgenerator.index_text(v['value'], 20)
+                self.index_text(termgenerator, 'general', v['value'])
 
         # This can be used to prevent phrase searches from spanning
         # two unconnected blocks of text (e.g. the title and body
@@ -311,14 +1115,22 @@ class MycorrhizaIndexer:
         # index the original authors and titles as received,
         # regardless of the merging (which is the boolean ones).
 
+        # the mirrors usually repeat them
+        unique_sources = self.index_fields['sources'].get('unique')
+        seen = set()
         for dsd in record['data_sources']:
             # index the original author as a string
-            for value in dsd.get('authors'):
-                termgenerator.index_text(value, 20)
+            values = list(dsd.get('authors'))
             for field in [ 'title', 'subtitle' ]:
                 value = dsd.get(field)
                 if value:
-                    termgenerator.index_text(value, 20)
+                    values.append(value)
+            for value in values:
+                if unique_sources:
+                    if value in seen:
+                        continue
+                    seen.add(value)
+                self.index_text(termgenerator, 'sources', value)
 
         for field in ['description', 'material_description']:
             termgenerator.increase_termpos()
@@ -326,7 +1138,7 @@ class MycorrhizaIndexer:
                 value = dsd.get(field)
                 if value:
                     # logger.debug("Indexing {} {}".format(field, value))
-                    termgenerator.index_text(value, 10)
+                    self.index_text(termgenerator, 'description', value)
 
         # if aggregation or aggregated, index titles and authors of
         # the related one as well.
@@ -336,24 +1148,35 @@ class MycorrhizaIndexer:
                 for agg in dsd[aggfield]:
                     termgenerator.increase_termpos()
                     for author in agg.get('authors', []):
-                        termgenerator.index_text(author, 20)
+                        self.index_text(termgenerator, 'aggregations', author)
                     for field in ['title', 'description']:
                         value = agg.get(field)
                         if value:
-                            termgenerator.index_text(value, 20)
+                            self.index_text(termgenerator, 'aggregations', value)
 
+        indexed_bytes = 0
         for ft in record.pop('full_texts'):
             if ft:
                 logger.debug("Indexing full text with {} chars".format(len(ft)))
                 termgenerator.increase_termpos()
-                termgenerator.index_text(ft)
+                if self.index_text(termgenerator, 'full_text', ft):
+                    indexed_bytes += len(ft)
 
-        doc.set_data(json.dumps(record))
+        doc.set_data(hit_data(record))
+        if record_hash:
+            doc.add_value(RECORD_HASH_SLOT, record_hash)
         idterm = "Q{}".format(identifier)
         doc.add_boolean_term(idterm)
+        db = self.dbs[identifier % len(self.dbs)]
+        built = time.perf_counter()
         if is_deleted:
-            self.logs.append("Removing document " + idterm)
-            self.db.delete_document(idterm)
+            self.delete_entry(identifier)
         else:
             self.logs.append("Indexing " + idterm)
-            self.db.replace_document(idterm, doc)
+            db.replace_document(idterm, doc)
+            self._count('written')
+        if self.profile:
+            self.profile.add(identifier, 'terms', built - started,
+                             size=indexed_bytes + len(doc.get_data()))
+            self.profile.add(identifier, 'write', time.perf_counter() - built)
+            self.profile.finish(identifier)
@@ -0,0 +1,133 @@
+from django.conf import settings
+from django.core.cache import caches
+from collections import OrderedDict
+from amwmeta.xapian import get_searcher
+import hashlib
+import json
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# the query parameters search() looks at, plus the filter_* ones
+SEARCH_PARAMS = [
+    'query',
+    'page_size',
+    'page_number',
+    'sort_by',
+    'sort_direction',
+    'cursor',
+]
+
+# the facets and the count cover the whole result set
+PAGING_PARAMS = [
+    'page_size',
+    'page_number',
+    'cursor',
+]
+
+class LocalResultCache:
+    """In-process LRU cache with a TTL"""
+    def __init__(self, timeout=300, max_entries=1000):
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            found = self.entries.get(key)
+            if found and found[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return found[1]
+            if found:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.timeout, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            "backend": "local",
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+        }
+
+class DjangoResultCache:
+    """Wrapper around one of the configured Django caches.
+    The counters are per process."""
+    def __init__(self, alias="default", timeout=300):
+        self.alias = alias
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        found = caches[self.alias].get(key)
+        if found is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return found
+
+    def set(self, key, value):
+        caches[self.alias].set(key, value, self.timeout)
+
+    def stats(self):
+        return {
+            "backend": "django:" + self.alias,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+_search_cache = None
+
+def get_search_cache():
+    global _search_cache
+    conf = settings.SEARCH_CACHE
+    if not conf or not conf.get('BACKEND'):
+        return None
+    if _search_cache is None:
+        if conf['BACKEND'] == 'django':
+            _search_cache = DjangoResultCache(alias=conf.get('ALIAS', 'default'),
+                                              timeout=conf.get('TIMEOUT', 300))
+        elif conf['BACKEND'] == 'local':
+            _search_cache = LocalResultCache(timeout=conf.get('TIMEOUT', 300),
+                                             max_entries=conf.get('MAX_ENTRIES', 1000))
+        else:
+            raise ValueError("Invalid SEARCH_CACHE backend " + str(conf['BACKEND']))
+    return _search_cache
+
+def search_cache_key(db_path, query_params, active_libraries, exclusions, extra=None):
+    # the uuid changes when the database is rebuilt from scratch,
+    # the revision on every commit
+    searcher = get_searcher(db_path)
+    params = []
+    for param in sorted(query_params.keys()):
+        if extra in ('facets', 'count') and param in PAGING_PARAMS:
+            continue
+        if param in SEARCH_PARAMS or param.startswith('filter_'):
+            values = sorted([ v for v in query_params.getlist(param) if v ])
+            if values:
+                params.append([ param, values ])
+    key = {
+        "db": [ searcher.db.get_uuid(), searcher.revision() ],
+        "params": params,
+        "libraries": sorted(active_libraries),
+        "exclusions": sorted([ list(e) for e in exclusions ]),
+        "extra": extra,
+    }
+    sha = hashlib.sha256()
+    sha.update(json.dumps(key, sort_keys=True).encode())
+    return "mycorrhiza-search-" + sha.hexdigest()
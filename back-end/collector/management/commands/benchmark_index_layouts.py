@@ -0,0 +1,87 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.http import QueryDict
+from amwmeta.xapian import MycorrhizaIndexer, INDEX_LAYOUTS, search
+from amwmeta.profiling import percentile
+from collector.models import Entry, Library, IndexingMemo
+from pathlib import Path
+import copy
+import tempfile
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = "Index a sample of the entries with each index layout and report the size and the query latency"
+    def add_arguments(self, parser):
+        parser.add_argument("--layout",
+                            action="append",
+                            choices=list(INDEX_LAYOUTS.keys()),
+                            help="Layout to test (repeatable, default all)")
+        parser.add_argument("--sample",
+                            type=int,
+                            default=1000,
+                            help="Number of entries to index")
+        parser.add_argument("--query",
+                            action="append",
+                            help="Query to time (repeatable, default some words and phrases from the titles)")
+        parser.add_argument("--repeat",
+                            type=int,
+                            default=20,
+                            help="Runs of each query")
+
+    def handle(self, *args, **options):
+        layouts = options['layout'] or list(INDEX_LAYOUTS.keys())
+        entries = Entry.objects.order_by('-id')[:options['sample']]
+        with IndexingMemo():
+            records = list(Entry.bulk_indexing_data(entries))
+        if not records:
+            raise CommandError("No entries to index")
+        queries = options['query'] or self.sample_queries(records)
+        libraries = list(Library.objects.values_list('id', flat=True))
+
+        print("{:10} {:>8} {:>10} {:>9} {:>9} {:>9} {:>9}".format(
+            "layout", "docs", "size (MB)", "build (s)", "p50 (ms)", "p90 (ms)", "matches"))
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in layouts:
+                db_path = str(Path(tmp, name))
+                started = time.monotonic()
+                with MycorrhizaIndexer(db_path=db_path, index_layout=name, force=True) as indexer:
+                    for record in records:
+                        # index_record consumes the full texts
+                        indexer.index_record(copy.deepcopy(record))
+                build = time.monotonic() - started
+                size = sum([ f.stat().st_size for f in Path(db_path).rglob('*') if f.is_file() ])
+
+                timings = []
+                matches = 0
+                for query in queries:
+                    params = QueryDict(mutable=True)
+                    params['query'] = query
+                    # warm up
+                    res = search(db_path, params, active_libraries=libraries)
+                    matches += res['pager'].total_entries
+                    for i in range(options['repeat']):
+                        started = time.perf_counter()
+                        search(db_path, params, active_libraries=libraries)
+                        timings.append(time.perf_counter() - started)
+                timings.sort()
+                print("{:10} {:>8} {:>10.2f} {:>9.1f} {:>9.2f} {:>9.2f} {:>9}".format(
+                    name,
+                    indexer.counters['written'],
+                    size / 1024 / 1024,
+                    build,
+                    percentile(timings, 50) * 1000,
+                    percentile(timings, 90) * 1000,
+                    matches))
+        print("Queries: " + ", ".join(queries))
+
+    def sample_queries(self, records):
+        # single words and phrases from the titles
+        queries = []
+        for record in records[:10]:
+            words = [ w for w in record['title'][0]['value'].split() if w.isalnum() ]
+            if words:
+                queries.append(words[0])
+            if len(words) > 1:
+                queries.append('"{} {}"'.format(words[0], words[1]))
+        return queries
@@ -1,41 +1,215 @@
 from django.core.management.base import BaseCommand, CommandError
-from amwmeta.xapian import MycorrhizaIndexer
-from collector.models import Site, Entry, Agent
+from amwmeta.xapian import (
+    MycorrhizaIndexer,
+    index_shards,
+    shard_path,
+    merge_shards,
+    merge_shard_labels,
+    index_revisions,
+    new_generation,
+    activate_generation,
+    prune_generations,
+    rollback_generation,
+    INDEX_LAYOUTS,
+)
+from amwmeta.profiling import IndexProfile, summary_lines
+from collector.models import Site, Entry, Agent, Harvest, QueryCounter, IndexingMemo, with_full_texts
+import fcntl
+import multiprocessing
+import os
 import shutil
+import time
 import logging
-from django.db import connection
+from django.db import connection, connections
+from django.db.models.functions import Mod
 from django.conf import settings
-from pathlib import Path
 import requests.exceptions
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
 logger = logging.getLogger(__name__)
 
+def build_shard(job):
+    # runs in a worker process
+    db_path, shard, shards, batch_size, profile_keep, index_layout = job
+    started = time.monotonic()
+    entries = Entry.indexing_queryset(Entry.objects.annotate(shard=Mod('id', shards)).filter(shard=shard).order_by('id'))
+    counter = QueryCounter()
+    profile = None
+    if profile_keep:
+        profile = IndexProfile(queries=lambda: counter.count, keep=profile_keep)
+    with connection.execute_wrapper(counter), IndexingMemo():
+        with MycorrhizaIndexer(db_path=db_path, batch_size=batch_size, profile=profile,
+                               index_layout=index_layout, on_commit=Entry.save_indexed_data) as indexer:
+            indexer.index_entries(with_full_texts(entries.iterator(chunk_size=batch_size), profile=profile,
+                                                  processes=shards))
+    return (shard, indexer.counters, time.monotonic() - started, profile)
+
+def build_shards(db_path, staging, workers, batch_size=1000, keep_shards=False, profile=None, index_layout=None):
+    # one worker per shard, then the shards are merged into staging
+    # or become the index themselves
+    report = []
+    shards_path = staging if keep_shards else new_generation(db_path)
+    profile_keep = profile.keep if profile else 0
+    jobs = [ (shard_path(shards_path, i), i, workers, batch_size, profile_keep, index_layout) for i in range(workers) ]
+    try:
+        # the forked workers must open their own connections
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            for shard, counters, elapsed, shard_profile in pool.imap_unordered(build_shard, jobs):
+                done = counters['written'] + counters['deleted']
+                report.append("Shard {}: {} entries in {:.1f}s ({:.1f}/s)".format(
+                    shard, done, elapsed, done / elapsed if elapsed else 0))
+                logger.info(report[-1])
+                if profile:
+                    profile.merge(shard_profile)
+
+        shards = index_shards(shards_path)
+        if keep_shards:
+            merge_shard_labels(shards)
+        else:
+            started = time.monotonic()
+            # compaction creates the destination
+            os.rmdir(staging)
+            merge_shards(shards, staging)
+            report.append("Merged {} shards in {:.1f}s".format(len(shards), time.monotonic() - started))
+    finally:
+        # the kept shards are the staging directory, removed by the
+        # caller on failure
+        if not keep_shards:
+            shutil.rmtree(shards_path, ignore_errors=True)
+    return report
+
+def lock_index_worker(db_path):
+    # the queued updates wait, the worker applies them to the new
+    # generation
+    lock = open(db_path + ".worker.lock", "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        raise CommandError("The index worker is running, stop it first")
+    return lock
+
+def rebuild_index(db_path, workers=1, batch_size=1000, keep_shards=False, keep_generations=3, profile=None,
+                  index_layout=None, worker_lock=None):
+    # the current generation keeps serving until the switch, so
+    # whatever is written to it meanwhile would be lost
+    started = time.monotonic()
+    lock = None
+    if worker_lock is None:
+        lock = lock_index_worker(db_path)
+    try:
+        revisions = index_revisions(db_path) if os.path.exists(db_path) else None
+        staging = new_generation(db_path)
+        try:
+            if workers > 1:
+                report = build_shards(db_path, staging, workers,
+                                      batch_size=batch_size, keep_shards=keep_shards, profile=profile,
+                                      index_layout=index_layout)
+            else:
+                query_counter = QueryCounter()
+                if profile:
+                    profile.queries = lambda: query_counter.count
+                with connection.execute_wrapper(query_counter), IndexingMemo():
+                    with MycorrhizaIndexer(db_path=staging, batch_size=batch_size, profile=profile,
+                                           index_layout=index_layout, on_commit=Entry.save_indexed_data) as indexer:
+                        counter = 0
+                        entries = Entry.indexing_queryset().iterator(chunk_size=batch_size)
+                        for entry in with_full_texts(entries, profile=profile):
+                            indexer.index_entries([ entry ])
+                            counter += 1
+                            if counter % 1000 == 0:
+                                logger.debug(str(counter) + " records done")
+                report = [ indexer.summary() ]
+            if revisions is not None and index_revisions(db_path) != revisions:
+                raise CommandError("The index was written during the rebuild, stop the harvests and retry")
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        report.append("Activated " + activate_generation(db_path, staging))
+    finally:
+        if lock:
+            lock.close()
+    for path in prune_generations(db_path, keep_generations):
+        report.append("Removed " + path)
+    report.append("Total: {:.1f}s".format(time.monotonic() - started))
+    return report
+
 class Command(BaseCommand):
     help = "Harvest the sites"
     def add_arguments(self, parser):
         parser.add_argument("--force",
                             action="store_true", # boolean
-                            help="Force a full harvest")
+                            help="Force a full harvest and rewrite the unchanged documents (and rebuild the index, without --site)")
         parser.add_argument("--site",
                             help="Select a specific site")
         parser.add_argument("--reindex",
                             action="store_true", # boolean
                             help="Do not fetch from OAI-PMH, just rebuild the Xapian index")
+        parser.add_argument("--rollback",
+                            action="store_true",
+                            help="Switch the index back to the previous generation")
+        parser.add_argument("--keep-generations",
+                            type=int,
+                            default=settings.XAPIAN_KEEP_GENERATIONS,
+                            help="Index generations to keep after a rebuild")
         parser.add_argument("--nuke-aliases",
                             action="store_true",
                             help="Remove all the aliases and variant relationships (only if --force without --site)")
         parser.add_argument("--entry",
                             help="Reindex a single entry")
+        parser.add_argument("--batch-size",
+                            type=int,
+                            default=settings.XAPIAN_INDEX_BATCH_SIZE,
+                            help="Documents indexed between commits")
+        parser.add_argument("--workers",
+                            type=int,
+                            default=settings.XAPIAN_INDEX_WORKERS,
+                            help="Rebuild the index with this many worker processes (with --reindex)")
+        parser.add_argument("--index-layout",
+                            choices=list(INDEX_LAYOUTS.keys()),
+                            default=settings.XAPIAN_INDEX_LAYOUT,
+                            help="How to index the text fields on a rebuild (see amwmeta.xapian.INDEX_LAYOUTS)")
+        parser.add_argument("--profile-index",
+                            type=int,
+                            nargs="?",
+                            const=20,
+                            metavar="N",
+                            help="Print the indexing timings and the N slowest entries (default 20)")
+        parser.add_argument("--keep-shards",
+                            action="store_true",
+                            default=settings.XAPIAN_SHARDED_INDEX,
+                            help="Serve from the shards built by the workers instead of merging them")
 
     def handle(self, *args, **options):
         logger.debug(options)
         db_path = settings.XAPIAN_DB
-        db_path_object = Path(settings.XAPIAN_DB)
-        if options['force'] and not options['site']:
-            if db_path and db_path_object.is_dir() and db_path_object.name == 'db':
-                shutil.rmtree(db_path)
+        rebuild_options = {
+            "workers": options['workers'],
+            "batch_size": options['batch_size'],
+            "keep_shards": options['keep_shards'],
+            "keep_generations": options['keep_generations'],
+            "index_layout": options['index_layout'],
+        }
+        profile = None
+        if options['profile_index']:
+            profile = IndexProfile(keep=options['profile_index'])
+            rebuild_options['profile'] = profile
+        if options['rollback']:
+            try:
+                print("Serving " + rollback_generation(db_path))
+            except ValueError as e:
+                raise CommandError(str(e))
+            return
+
+        worker_lock = None
+        if options['force'] and not (options['site'] or options['entry'] or options['reindex']):
+            # the rebuild after the harvests needs the index worker
+            # stopped, fail now rather than hours later
+            worker_lock = lock_index_worker(db_path)
+            rebuild_options['worker_lock'] = worker_lock
 
+        if options['force'] and not options['site']:
             if options['nuke_aliases']:
                 print("Cleaning aliases")
                 Agent.objects.filter(canonical_agent_id__isnull=False).update(canonical_agent=None)
@@ -43,23 +217,29 @@ class Command(BaseCommand):
                 print(connection.queries)
 
         if options['entry']:
-            indexer = MycorrhizaIndexer(db_path=db_path)
-            entry = Entry.objects.get(pk=options['entry'])
-            data = entry.indexing_data()
-            pp.pprint(data)
-            indexer.index_record(data)
+            with MycorrhizaIndexer(db_path=db_path, force=True) as indexer:
+                entry = Entry.objects.get(pk=options['entry'])
+                data = entry.indexing_data()
+                pp.pprint(data)
+                indexer.index_record(data)
+            Entry.save_indexed_data([ entry ])
             return
 
         if options['reindex']:
-            indexer = MycorrhizaIndexer(db_path=db_path)
-            counter = 0
-            for entry in Entry.objects.all():
-                indexer.index_record(entry.indexing_data())
-                counter += 1
-                if counter % 1000 == 0:
-                    logger.debug(str(counter) + " records done")
+            print("\n".join(rebuild_index(db_path, **rebuild_options)))
+            if profile:
+                self.print_profile(profile.report(), profile.slowest())
             return
 
+        try:
+            self.harvest_sites(db_path, options, rebuild_options, profile)
+        finally:
+            if worker_lock:
+                worker_lock.close()
+
+    def harvest_sites(self, db_path, options, rebuild_options, profile):
+        last_harvest = Harvest.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
         rs = Site.objects.filter(active=True)
         if options['site']:
             rs = rs.filter(url__contains=options['site'])
@@ -71,3 +251,22 @@ class Command(BaseCommand):
                 print("Server error for {}, skipping".format(site.url))
             except requests.exceptions.ConnectionError:
                 print("Failure on connection to {}, skipping".format(site.url))
+
+        if options['profile_index']:
+            for harvest in Harvest.objects.filter(id__gt=last_harvest, stats__isnull=False).order_by('id'):
+                print(str(harvest))
+                self.print_profile(summary_lines(harvest.stats),
+                                   harvest.stats['slowest'][:options['profile_index']])
+
+        if options['force'] and not options['site']:
+            # the harvests updated the live index, now drop what is stale
+            print("\n".join(rebuild_index(db_path, **rebuild_options)))
+            if profile:
+                self.print_profile(profile.report(), profile.slowest())
+
+    def print_profile(self, lines, slowest):
+        for line in lines:
+            print(line)
+        for record in slowest:
+            stages = " ".join([ "{}={:.3f}s".format(k, v) for k, v in record['stages'].items() ])
+            print("Entry {entry_id}: {seconds:.3f}s, {queries} queries, {bytes} bytes".format(**record) + " " + stages)
@@ -0,0 +1,165 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db.models import Q, Exists, OuterRef
+from amwmeta.xapian import (
+    MycorrhizaIndexer,
+    index_shards,
+    merge_shards,
+    open_index,
+    index_revisions,
+    index_stats,
+    new_generation,
+    activate_generation,
+    prune_generations,
+)
+from collector.models import Entry, DataSource, IndexingMemo, with_full_texts, prune_full_texts
+from collector.management.commands.harvest import lock_index_worker
+import os
+import shutil
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+def expected_entries():
+    # same rule of MycorrhizaIndexer.index_record: the aggregations,
+    # merged or not, and the canonical entries with a data source of
+    # their own or of a variant (see Entry.indexed_data_sources)
+    return Entry.objects.filter(
+        Q(is_aggregation=True)
+        | Q(canonical_entry__isnull=True) & (
+            Exists(DataSource.objects.filter(entry_id=OuterRef('pk')))
+            | Exists(DataSource.objects.filter(entry__canonical_entry_id=OuterRef('pk')))
+        )
+    )
+
+def check_index(db_path, chunk_size=1000):
+    # the ids of the documents to remove and of the entries to
+    # index. Both sides are walked in chunks.
+    db = open_index(db_path)
+    expected = expected_entries()
+    stale = []
+
+    def check_chunk(chunk):
+        found = set(expected.filter(id__in=chunk).values_list('id', flat=True))
+        stale.extend([ i for i in chunk if i not in found ])
+
+    chunk = []
+    for item in db.allterms('Q'):
+        chunk.append(int(item.term[1:]))
+        if len(chunk) >= chunk_size:
+            check_chunk(chunk)
+            chunk = []
+    if chunk:
+        check_chunk(chunk)
+
+    missing = []
+    for entry_id in expected.order_by('id').values_list('id', flat=True).iterator(chunk_size=chunk_size):
+        if not db.term_exists("Q{}".format(entry_id)):
+            missing.append(entry_id)
+    db.close()
+    return (stale, missing)
+
+def repair_index(db_path, stale, missing, batch_size=1000, chunk_size=1000):
+    with IndexingMemo(), MycorrhizaIndexer(db_path=db_path, batch_size=batch_size,
+                                           on_commit=Entry.save_indexed_data) as indexer:
+        for entry_id in stale:
+            indexer.delete_entry(entry_id)
+        for i in range(0, len(missing), chunk_size):
+            entries = Entry.indexing_queryset(Entry.objects.filter(id__in=missing[i:i + chunk_size]))
+            indexer.index_entries(with_full_texts(entries))
+    return indexer.counters
+
+def compact_index(db_path, keep_generations=3):
+    # a sharded index becomes a single database
+    started = time.monotonic()
+    revisions = index_revisions(db_path)
+    staging = new_generation(db_path)
+    try:
+        # compaction creates the destination
+        os.rmdir(staging)
+        merge_shards(index_shards(db_path) or [ db_path ], staging)
+        if index_revisions(db_path) != revisions:
+            raise CommandError("The index was written during the compaction, stop the writers and retry")
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    report = [ "Compacted in {:.1f}s".format(time.monotonic() - started) ]
+    report.append("Activated " + activate_generation(db_path, staging))
+    for path in prune_generations(db_path, keep_generations):
+        report.append("Removed " + path)
+    return report
+
+def stats_lines(stats):
+    lines = [
+        "Path: {path}".format(**stats),
+        "Shards: {shards}".format(**stats),
+        "Index layout: {index_layout}".format(**stats),
+        "Documents: {documents} (last docid {last_docid})".format(**stats),
+        "Average document length: {average_length:.1f}".format(**stats),
+        "Size on disk: {:.1f} MB".format(stats['size'] / 1024 / 1024),
+        "Terms by prefix:",
+    ]
+    for prefix, counts in stats['terms'].items():
+        if counts['terms']:
+            lines.append("  {:6} {:28} {:>10} terms {:>12} postings".format(
+                prefix or "-", counts['name'], counts['terms'], counts['postings']))
+    return lines
+
+class Command(BaseCommand):
+    help = "Print the index statistics, compact the index, check it against the database and prune the stored texts"
+    def add_arguments(self, parser):
+        parser.add_argument("--stats",
+                            action="store_true",
+                            help="Print the statistics (the default without other actions)")
+        parser.add_argument("--compact",
+                            action="store_true",
+                            help="Compact the index into a new generation and switch to it")
+        parser.add_argument("--check",
+                            action="store_true",
+                            help="Report the entries missing from the index and the stale documents")
+        parser.add_argument("--repair",
+                            action="store_true",
+                            help="Check, then index the missing entries and remove the stale documents")
+        parser.add_argument("--prune-texts",
+                            action="store_true",
+                            help="Remove the stored full texts no data source uses any more")
+        parser.add_argument("--chunk-size",
+                            type=int,
+                            default=1000,
+                            help="Ids compared with a single query")
+        parser.add_argument("--batch-size",
+                            type=int,
+                            default=settings.XAPIAN_INDEX_BATCH_SIZE,
+                            help="Documents repaired between commits")
+        parser.add_argument("--keep-generations",
+                            type=int,
+                            default=settings.XAPIAN_KEEP_GENERATIONS,
+                            help="Index generations to keep after the compaction")
+
+    def handle(self, *args, **options):
+        db_path = settings.XAPIAN_DB
+        if options['compact'] or options['repair']:
+            # the queued updates wait, see the index_worker command
+            lock = lock_index_worker(db_path)
+
+        if options['check'] or options['repair']:
+            stale, missing = check_index(db_path, chunk_size=options['chunk_size'])
+            print("Stale documents: {}".format(len(stale)))
+            print("Missing entries: {}".format(len(missing)))
+            for label, ids in (("Stale", stale), ("Missing", missing)):
+                if ids:
+                    logger.info("{}: {}".format(label, " ".join([ str(i) for i in ids ])))
+            if options['repair'] and (stale or missing):
+                counters = repair_index(db_path, stale, missing,
+                                        batch_size=options['batch_size'],
+                                        chunk_size=options['chunk_size'])
+                print("Repaired. Written: {written}, deleted: {deleted}".format(**counters))
+
+        if options['prune_texts']:
+            print("Removed {} stored texts".format(prune_full_texts(chunk_size=options['chunk_size'])))
+
+        if options['compact']:
+            print("\n".join(compact_index(db_path, keep_generations=options['keep_generations'])))
+
+        if options['stats'] or not (options['compact'] or options['check'] or options['repair'] or options['prune_texts']):
+            print("\n".join(stats_lines(index_stats(db_path))))
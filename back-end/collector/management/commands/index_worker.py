@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from collector.models import process_reindex_queue
+import fcntl
+import time
+import logging
+import xapian
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = "Reindex the entries queued by the user operations"
+    def add_arguments(self, parser):
+        parser.add_argument("--once",
+                            action="store_true",
+                            help="Drain the queue and exit")
+        parser.add_argument("--batch-size",
+                            type=int,
+                            default=settings.XAPIAN_INDEX_BATCH_SIZE,
+                            help="Queued entries processed in a single indexing session")
+        parser.add_argument("--interval",
+                            type=float,
+                            default=settings.XAPIAN_INDEX_WORKER_INTERVAL,
+                            help="Seconds to wait when the queue is empty")
+
+    def handle(self, *args, **options):
+        # a single worker, so the writes to the index don't collide
+        lock = open(settings.XAPIAN_DB + ".worker.lock", "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise CommandError("Another index worker is running")
+
+        while True:
+            try:
+                done = process_reindex_queue(batch_size=options['batch_size'])
+            except xapian.DatabaseLockError:
+                # a harvest is writing, the queue is still there
+                logger.info("Index locked, retrying later")
+                done = 0
+            if done:
+                logger.info("Reindexed {} entries".format(done))
+                continue
+            if options['once']:
+                return
+            time.sleep(options['interval'])
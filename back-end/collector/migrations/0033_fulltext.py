@@ -0,0 +1,27 @@
+# Generated by Django 5.0.1 on 2026-10-18 11:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collector', '0032_reindexjob_reindexqueue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FullText',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.URLField(max_length=2048)),
+                ('sha256', models.CharField(db_index=True, max_length=64)),
+                ('etag', models.CharField(max_length=255, null=True)),
+                ('http_last_modified', models.CharField(max_length=64, null=True)),
+                ('fetched', models.DateTimeField()),
+                ('checked', models.DateTimeField()),
+                ('data_source', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='stored_full_text', to='collector.datasource')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-18 11:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collector', '0033_fulltext'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='harvest',
+            name='stats',
+            field=models.JSONField(null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-18 12:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collector', '0034_harvest_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='indexed_hash',
+            field=models.CharField(max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collector', '0035_entry_indexed_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasource',
+            name='file_manifest',
+            field=models.JSONField(null=True),
+        ),
+    ]
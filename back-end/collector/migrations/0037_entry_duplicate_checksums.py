@@ -0,0 +1,33 @@
+# Generated by Django 5.0.1 on 2026-10-18 15:10
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+def rename_duplicate_checksums(apps, schema_editor):
+    # The harvest picked the oldest entry with a checksum, so keep that
+    # one and give the others a checksum of their own before the
+    # constraint goes in.
+    Entry = apps.get_model("collector", "Entry")
+    duplicates = Entry.objects.values('checksum', 'is_aggregation').annotate(
+        count=Count('id'),
+        first=Min('id'),
+    ).filter(count__gt=1)
+    for dup in duplicates:
+        others = Entry.objects.filter(
+            checksum=dup['checksum'],
+            is_aggregation=dup['is_aggregation'],
+        ).exclude(id=dup['first'])
+        for entry_id in others.values_list('id', flat=True):
+            Entry.objects.filter(id=entry_id).update(
+                checksum="{}:duplicate:{}".format(dup['checksum'][0:200], entry_id)
+            )
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collector', '0036_datasource_file_manifest'),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_duplicate_checksums, migrations.RunPython.noop)
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.0.1 on 2026-10-18 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('collector', '0037_entry_duplicate_checksums'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='entry',
+            constraint=models.UniqueConstraint(fields=('checksum', 'is_aggregation'), name='unique_entry_checksum_is_aggregation'),
+        ),
+    ]
@@ -1,19 +1,27 @@
 from django.db import models
 from amwmeta.harvest import harvest_oai_pmh, extract_fields
 from urllib.parse import urlparse
-from datetime import datetime, timezone
-from django.db import transaction
+from datetime import datetime, timezone, timedelta
+from django.db import transaction, connection
 from amwmeta.xapian import MycorrhizaIndexer
-from amwmeta.calibre import scan_calibre_tree
+from amwmeta.calibre import scan_calibre_tree, file_manifest
+from amwmeta.textstore import TextStore
+from amwmeta.fetcher import HostLimitedFetcher
+from amwmeta.profiling import IndexProfile
+from concurrent.futures import as_completed, wait, FIRST_COMPLETED
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.db.models import Max, Prefetch
 import logging
 from amwmeta.sheets import parse_sheet, normalize_records
 import random
 import requests
 import re
 import pprint
+import contextvars
 import hashlib
+import json
+import time
 from pathlib import Path
 
 pp = pprint.PrettyPrinter(indent=2)
@@ -238,26 +246,36 @@ class Site(models.Model):
         self.index_harvested_records(xapian_records, force=force, now=now, set_last_harvested=set_last_harvested)
 
     def index_harvested_records(self, xapian_records, force=False, now=None, set_last_harvested=True):
-        indexer = MycorrhizaIndexer(db_path=settings.XAPIAN_DB)
         all_ids = list(set(xapian_records))
         logger.debug("Indexing " + str(all_ids))
-        for iid in all_ids:
-            try:
-                ientry = Entry.objects.get(pk=iid)
-                indexer.index_record(ientry.indexing_data())
-            except Entry.DoesNotExist:
-                logger.info("Entry id {} not found?!".format(iid))
+        counter = QueryCounter()
+        profile = IndexProfile(queries=lambda: counter.count, keep=settings.INDEX_PROFILE_KEEP)
+        with connection.execute_wrapper(counter), IndexingMemo():
+            with MycorrhizaIndexer(db_path=settings.XAPIAN_DB,
+                                   batch_size=settings.XAPIAN_INDEX_BATCH_SIZE,
+                                   profile=profile,
+                                   force=force,
+                                   on_commit=Entry.save_indexed_data) as indexer:
+                entries = Entry.indexing_queryset().in_bulk(all_ids)
+                for iid in all_ids:
+                    if iid not in entries:
+                        logger.info("Entry id {} not found?!".format(iid))
+                        indexer.skip()
+                indexer.index_entries(with_full_texts(entries.values(), profile=profile))
 
         logs = indexer.logs
         if logs:
             msg = "Total indexed: " + str(len(logs))
             # logger.info(msg)
             logs.append(msg)
+            logs.append(indexer.summary())
             if set_last_harvested:
                 logger.info("Setting last harvested to {}".format(now))
                 self.last_harvested = now
                 self.save()
-            self.harvest_set.create(datetime=now, logs="\n".join(logs))
+            stats = profile.summary()
+            stats['slowest'] = profile.slowest()
+            self.harvest_set.create(datetime=now, logs="\n".join(logs), stats=stats)
 
     def process_harvested_record(self, record, aliases, now):
         aggregations = record.pop('aggregations', [])
@@ -289,15 +307,8 @@ class Site(models.Model):
                     "aggregation": agg_ds,
                     "aggregated": ds,
                 }
-                try:
-                    AggregationEntry.objects.get(**entry_rel)
-                except AggregationEntry.DoesNotExist:
-                    AggregationEntry.objects.create(**entry_rel)
-
-                try:
-                    relation = AggregationDataSource.objects.get(**ds_rel_spec)
-                except AggregationDataSource.DoesNotExist:
-                    relation = AggregationDataSource.objects.create(**ds_rel_spec)
+                AggregationEntry.objects.get_or_create(**entry_rel)
+                relation, created = AggregationDataSource.objects.get_or_create(**ds_rel_spec)
 
                 if agg.get('order'):
                     try:
@@ -340,6 +351,7 @@ class Site(models.Model):
             'year_edition',
             'year_first_edition',
             'description',
+            'file_manifest',
         ]
         ds_attrs = { x: record.pop(x, None) for x in ds_attributes }
 
@@ -347,21 +359,20 @@ class Site(models.Model):
             "oai_pmh_identifier": identifier,
             "is_aggregation": is_aggregation,
         }
+        # if not provided, use the current time if the datestamp is null
+        datestamp = record.pop('datestamp') if record.get('datestamp') else None
         try:
-            ds = self.datasource_set.get(**ds_identifiers)
-            for attr, value in ds_attrs.items():
-                setattr(ds, attr, value)
-            ds.save()
+            ds = self.datasource_set.select_related('entry').get(**ds_identifiers)
+            if datestamp or not ds.datestamp:
+                ds_attrs['datestamp'] = datestamp or now
+            # an unchanged record keeps its last_modified
+            changed = [ attr for attr, value in ds_attrs.items() if getattr(ds, attr) != value ]
+            if changed:
+                for attr in changed:
+                    setattr(ds, attr, ds_attrs[attr])
+                ds.save()
         except DataSource.DoesNotExist:
-            ds = self.datasource_set.create(**ds_identifiers, **ds_attrs)
-
-        # if not provided, use the current time if the datestamp is null
-        if record.get('datestamp'):
-            ds.datestamp = record.pop('datestamp')
-            ds.save()
-        elif not ds.datestamp:
-            ds.datestamp = now
-            ds.save()
+            ds = self.datasource_set.create(**ds_identifiers, **ds_attrs, datestamp=datestamp or now)
 
         for f in [ 'title', 'subtitle' ]:
             f_value = record.get(f, '')
@@ -383,27 +394,37 @@ class Site(models.Model):
 
         if not entry:
             # check if there's already a entry with the same checksum.
-            try:
-                entry = Entry.objects.get(checksum=record['checksum'], is_aggregation=is_aggregation)
-            except Entry.DoesNotExist:
-                entry = Entry.objects.create(**record, is_aggregation=is_aggregation)
-            except Entry.MultipleObjectsReturned:
-                entry = Entry.objects.filter(checksum=record['checksum'], is_aggregation=is_aggregation).first()
+            # The pair is unique, so a concurrent harvest creating the
+            # same entry makes get_or_create() fetch it instead.
+            entry, created = Entry.objects.get_or_create(checksum=record['checksum'],
+                                                         is_aggregation=is_aggregation,
+                                                         defaults=record)
             ds.entry = entry
             ds.save()
-
-        # update the entry and assign the many to many
-        for attr, value in record.items():
-            setattr(entry, attr, value)
-
-        entry.authors.set(authors)
-        entry.languages.set(languages)
+        elif entry.checksum != record['checksum'] and \
+             Entry.objects.filter(checksum=record['checksum'], is_aggregation=is_aggregation).exists():
+            # the record changed into one we already have from
+            # elsewhere: keep the entry as it is, merging is up to the
+            # users
+            logger.info("Checksum {} already taken, keeping {} for entry {}".format(record['checksum'],
+                                                                                   entry.checksum,
+                                                                                   entry.id))
+            record.pop('checksum')
 
         # datestamp: use the most recent
         if not entry.datestamp or ds.datestamp > entry.datestamp:
-            entry.datestamp = ds.datestamp
+            record['datestamp'] = ds.datestamp
 
-        entry.save()
+        # update the entry, saving it only if something changed, so
+        # last_modified tells when it did
+        changed = [ attr for attr, value in record.items() if getattr(entry, attr) != value ]
+        if changed:
+            for attr in changed:
+                setattr(entry, attr, record[attr])
+            entry.save()
+
+        entry.authors.set(authors)
+        entry.languages.set(languages)
         return (entry, ds)
 
     def process_generic_records(self, records, replace_all=False):
@@ -430,6 +451,9 @@ class Site(models.Model):
                 record['identifier'] = '{}:{}:{}'.format(site_type_ids.get(self.site_type, "x"),
                                                          hostname,
                                                          full['identifier'][0])
+            # stored in its own column, see DataSource.calibre_files()
+            if full.get('file_manifest'):
+                record['file_manifest'] = full.pop('file_manifest')
             record['full_data'] = full
             record['deleted'] = False
             for entry in self.process_harvested_record(record, aliases, now):
@@ -438,7 +462,8 @@ class Site(models.Model):
 
     def process_calibre_tree(self):
         if self.site_type == 'calibretree' and self.tree_path:
-            records = scan_calibre_tree(self.tree_path)
+            manifests = dict(self.datasource_set.filter(file_manifest__isnull=False).values_list('uri', 'file_manifest'))
+            records = scan_calibre_tree(self.tree_path, manifests=manifests)
             logger.debug(pp.pprint(records))
             self.process_generic_records(records)
 
@@ -521,6 +546,11 @@ class Language(models.Model):
     def __str__(self):
         return self.code
 
+def sorted_links(links):
+    # sorted here instead of in the query, so the prefetched links
+    # are used. The nulls go last, as in PostgreSQL.
+    return sorted(links, key=lambda link: (link.sorting_pos is None, link.sorting_pos or 0, link.id))
+
 class Entry(models.Model):
     title = models.CharField(max_length=255)
     subtitle = models.CharField(max_length=255, null=True)
@@ -537,6 +567,8 @@ class Entry(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     last_modified = models.DateTimeField(auto_now=True)
     indexed_data = models.JSONField(null=True)
+    # sha256 of the indexed record and full texts
+    indexed_hash = models.CharField(max_length=64, null=True)
 
     original_entry = models.ForeignKey(
         'self',
@@ -548,6 +580,9 @@ class Entry(models.Model):
 
     class Meta:
         verbose_name_plural = "Entries"
+        constraints = [
+            models.UniqueConstraint(fields=['checksum', 'is_aggregation'], name='unique_entry_checksum_is_aggregation'),
+        ]
 
     def __str__(self):
         return self.title
@@ -634,17 +669,71 @@ class Entry(models.Model):
 
         return record
 
-    def indexing_data(self):
-        # we index the entries
+    def indexed_data_sources(self):
         data_source_records = []
 
         # if canonical entry is set, it was merged so it will not be
         # indexed as such.
 
-        if not self.canonical_entry:
+        if not self.canonical_entry_id:
             data_source_records = [ xopr for xopr in self.datasource_set.all() ]
             for variant in self.variant_entries.all():
                 data_source_records.extend([ xopr for xopr in variant.datasource_set.all() ])
+        return data_source_records
+
+    @classmethod
+    def indexing_queryset(cls, queryset=None):
+        # everything indexing_data() and with_full_texts() look at,
+        # so a chunk costs the same queries whatever its size
+        if queryset is None:
+            queryset = cls.objects.all()
+        data_sources = DataSource.objects.select_related(
+            'site__library',
+            'entry',
+            'stored_full_text',
+        ).prefetch_related(
+            'entry__authors',
+            'entry__languages',
+            Prefetch('aggregation_data_sources',
+                     queryset=AggregationDataSource.objects.select_related(
+                         'aggregation__site__library',
+                         'aggregation__entry',
+                     ).prefetch_related('aggregation__entry__authors', 'aggregation__entry__languages')),
+            Prefetch('aggregated_data_sources',
+                     queryset=AggregationDataSource.objects.select_related(
+                         'aggregated__site__library',
+                         'aggregated__entry',
+                     ).prefetch_related('aggregated__entry__authors', 'aggregated__entry__languages')),
+        )
+        return queryset.prefetch_related(
+            Prefetch('authors', queryset=Agent.objects.select_related('canonical_agent')),
+            'languages',
+            Prefetch('datasource_set', queryset=data_sources),
+            Prefetch('variant_entries__datasource_set', queryset=data_sources),
+            Prefetch('aggregation_entries', queryset=AggregationEntry.objects.select_related('aggregation')),
+            Prefetch('aggregated_entries', queryset=AggregationEntry.objects.select_related('aggregated')),
+            Prefetch('translations', queryset=Entry.objects.only('id', 'original_entry')),
+        )
+
+    @classmethod
+    def save_indexed_data(cls, entries):
+        # the on_commit of MycorrhizaIndexer
+        changed = [ e for e in entries if getattr(e, 'indexed_data_changed', False) ]
+        if changed:
+            cls.objects.bulk_update(changed, ['indexed_data', 'indexed_hash'], batch_size=500)
+        for e in changed:
+            e.indexed_data_changed = False
+        return len(changed)
+
+    @classmethod
+    def bulk_indexing_data(cls, queryset, chunk_size=1000, profile=None):
+        entries = cls.indexing_queryset(queryset).iterator(chunk_size=chunk_size)
+        for entry in with_full_texts(entries, profile=profile):
+            yield entry.indexing_data()
+
+    def indexing_data(self):
+        # we index the entries
+        data_source_records = self.indexed_data_sources()
 
         authors  = []
         for author in self.authors.all():
@@ -665,8 +754,8 @@ class Entry(models.Model):
         for topr in data_source_records:
             dsd = topr.indexing_data()
             # at DS level
-            dsd['aggregations'] = [ ds.aggregation.indexing_data() for ds in topr.aggregation_data_sources.order_by('sorting_pos').all() ]
-            dsd['aggregated']   = [ ds.aggregated.indexing_data() for ds in topr.aggregated_data_sources.order_by('sorting_pos').all() ]
+            dsd['aggregations'] = [ IndexingMemo.fragment(ds.aggregation) for ds in sorted_links(topr.aggregation_data_sources.all()) ]
+            dsd['aggregated']   = [ IndexingMemo.fragment(ds.aggregated) for ds in sorted_links(topr.aggregated_data_sources.all()) ]
             xapian_data_sources.append(dsd)
             if dsd['public']:
                 record_is_public = True
@@ -752,10 +841,23 @@ class Entry(models.Model):
         if len(xapian_record['library']) == 1:
             xapian_record['unique_source'] = xapian_record['library'][0]['id']
 
-        self.indexed_data = xapian_record
-        self.save()
+        # what goes into the index
+        sha = hashlib.sha256()
+        sha.update(json.dumps(xapian_record, sort_keys=True, default=str).encode())
+        for ft in full_texts:
+            sha.update(b"\x00" + (ft or "").encode())
+        record_hash = sha.hexdigest()
+
+        # stored by save_indexed_data(), without touching the other
+        # columns and last_modified
+        self.indexed_data_changed = record_hash != self.indexed_hash
+        if self.indexed_data_changed:
+            # a copy, the full texts and the hash are not stored
+            self.indexed_data = dict(xapian_record)
+            self.indexed_hash = record_hash
 
         xapian_record['full_texts'] = full_texts
+        xapian_record['record_hash'] = record_hash
 
         return xapian_record
 
@@ -795,19 +897,10 @@ class Entry(models.Model):
         if name:
             sha = hashlib.sha256()
             sha.update(name.encode())
-            record = {
-                "title": name,
-                "checksum": sha.hexdigest(),
-                "is_aggregation": True,
-            }
-            # here there's no uniqueness in the schema, but we enforce it
-            try:
-                created = cls.objects.get(**record)
-            except cls.DoesNotExist:
-                created = cls.objects.create(**record)
-            except cls.MultipleObjectsReturned:
-                logger.debug("Multiple rows found, using the first")
-                created = cls.objects.filter(**record).first()
+            # the checksum is unique for the aggregations
+            created, was_created = cls.objects.get_or_create(checksum=sha.hexdigest(),
+                                                             is_aggregation=True,
+                                                             defaults={ "title": name })
             return created
         return None
 
@@ -912,6 +1005,8 @@ class DataSource(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     last_modified = models.DateTimeField(auto_now=True)
     is_aggregation = models.BooleanField(default=False)
+    # calibretree: the files of the book directory, see calibre_files()
+    file_manifest = models.JSONField(null=True)
 
     class Meta:
         constraints = [
@@ -942,50 +1037,125 @@ class DataSource(models.Model):
         else:
             return None
 
-    def get_calibre_file(self, ext):
+    def calibre_files(self):
+        # the listing recorded on the data source, redone only when
+        # the mtime of the book directory changes
+        return self.refresh_file_manifest()['files']
+
+    def refresh_file_manifest(self):
         tree = self.calibre_base_dir()
         if tree:
-            for f in tree.iterdir():
-                if f.suffix == ext:
-                    return f
+            known = self.file_manifest
+            if known and known['mtime'] == tree.stat().st_mtime_ns:
+                return known
+            manifest = file_manifest(str(tree))
+        else:
+            manifest = { "mtime": None, "files": [] }
+        if manifest != self.file_manifest:
+            self.file_manifest = manifest
+            # not a save(), the record did not change
+            DataSource.objects.filter(pk=self.pk).update(file_manifest=manifest)
+        return manifest
+
+    def get_calibre_file(self, ext):
+        for f in self.calibre_files():
+            if f['ext'] == ext:
+                path = Path(self.uri, f['name'])
+                if path.is_file():
+                    return path
         return None
 
+    def stored_text(self):
+        # cached on the instance, see store_full_text()
+        try:
+            return self.stored_full_text
+        except FullText.DoesNotExist:
+            return None
+
     def full_text(self):
         site_type = self.site.site_type
         if site_type == 'amusewiki':
-            amusewiki_url = self.amusewiki_base_url()
-            if amusewiki_url:
+            if hasattr(self, 'prefetched_full_text'):
+                # already tried by with_full_texts(), even if it failed
+                return self.prefetched_full_text
+            if self.amusewiki_base_url():
+                stored, stale = self.full_text_state()
+                if not stale:
+                    return stored.text()
+                url, headers = self.full_text_request(stored)
                 try:
-                    r = requests.get(amusewiki_url + '.bare.html')
-                    if r.status_code == 200:
-                        r.encoding = 'UTF-8'
-                        return r.text
-                except ConnectionError:
-                    logger.info("GET {0} had a connection error".format(endpoint))
-                except Timeout:
-                    logger.info("GET {0} timed out".format(endpoint))
-                except TooManyRedirects:
-                    logger.info("GET {0} had too many redirections".format(endpoint))
+                    r = requests.get(url, headers=headers, timeout=settings.FULL_TEXT_TIMEOUT)
+                except requests.exceptions.RequestException as e:
+                    r = e
+                return self.store_full_text(stored, url, r)
 
         elif site_type == 'calibretree':
-            tree = self.calibre_base_dir()
-            if tree:
-                for f in tree.iterdir():
-                    if f.suffix == '.txt':
-                        text = f.read_text(encoding='UTF-8')
-                        replacements = (
-                            ('&', '&amp;'),
-                            ('<', '&lt;'),
-                            ('>', '&gt;'),
-                            ('"', '&quot;'),
-                            ("'", '&#39;'),
-                            ("\n", '<br>'),
-                        )
-                        for replace in replacements:
-                            text = text.replace(replace[0], replace[1],)
-                        return text
+            f = self.get_calibre_file('.txt')
+            if f:
+                text = f.read_text(encoding='UTF-8')
+                replacements = (
+                    ('&', '&amp;'),
+                    ('<', '&lt;'),
+                    ('>', '&gt;'),
+                    ('"', '&quot;'),
+                    ("'", '&#39;'),
+                    ("\n", '<br>'),
+                )
+                for replace in replacements:
+                    text = text.replace(replace[0], replace[1],)
+                return text
         return None
 
+    def full_text_state(self):
+        # the stored text, if any, and whether to fetch it again
+        stored = self.stored_text()
+        if stored and not stored.exists():
+            stored = None
+        return stored, not (stored and stored.is_fresh(self.datestamp))
+
+    def full_text_request(self, stored=None):
+        # for a conditional GET
+        url = self.amusewiki_base_url() + '.bare.html'
+        headers = {}
+        if stored and stored.url == url:
+            if stored.etag:
+                headers['If-None-Match'] = stored.etag
+            if stored.http_last_modified:
+                headers['If-Modified-Since'] = stored.http_last_modified
+        return url, headers
+
+    def store_full_text(self, stored, url, r):
+        # r is the response to full_text_request(), or the exception
+        # it raised. On failure the stored copy is returned.
+        now = datetime.now(timezone.utc)
+        if isinstance(r, Exception):
+            logger.info("GET {0} failed: {1}".format(url, r))
+            return stored.text() if stored else None
+
+        if r.status_code == 304 and stored:
+            stored.checked = now
+            stored.save(update_fields=['checked'])
+            return stored.text()
+        elif r.status_code == 200:
+            r.encoding = 'UTF-8'
+            text = r.text
+            self.stored_full_text, created = FullText.objects.update_or_create(
+                data_source=self,
+                defaults={
+                    "url": url,
+                    "sha256": full_text_store().put(text),
+                    "etag": r.headers.get('ETag'),
+                    "http_last_modified": r.headers.get('Last-Modified'),
+                    "fetched": now,
+                    "checked": now,
+                })
+            return text
+        else:
+            logger.info("GET {0} returned {1}".format(url, r.status_code))
+            if stored and r.status_code >= 500:
+                return stored.text()
+            return None
+
     def download_options(self):
         site = self.site
         if self.is_aggregation:
@@ -994,32 +1164,30 @@ class DataSource(models.Model):
             # all files are supposed to have the same downloads, more or less
             return site.amusewiki_formats
         elif site.site_type == 'calibretree':
-            # the URI here holds the directory, so look into the dir
+            # the URI here holds the directory, the files are in the manifest
             downloads = []
-            tree = self.calibre_base_dir()
-            if tree:
-                # we consider just a file per extension. If there are
-                # multiple, at this moment we don't care
-                download_options = {
-                    ".pdf": "PDF",
-                    ".epub": "EPUB",
-                    ".txt": "TXT",
-                }
-                seen = []
-                for f in tree.iterdir():
-                    if f.suffix in download_options:
-                        if f.suffix not in seen:
-                            downloads.append({
-                                "ext": f.suffix,
-                                "desc": download_options[f.suffix],
-                            })
-                            seen.append(f.suffix)
+            # we consider just a file per extension. If there are
+            # multiple, at this moment we don't care
+            download_options = {
+                ".pdf": "PDF",
+                ".epub": "EPUB",
+                ".txt": "TXT",
+            }
+            seen = []
+            for f in self.calibre_files():
+                if f['ext'] in download_options:
+                    if f['ext'] not in seen:
+                        downloads.append({
+                            "ext": f['ext'],
+                            "desc": download_options[f['ext']],
+                        })
+                        seen.append(f['ext'])
             return downloads
         else:
             return []
 
     def indexing_data(self):
-        site = self.site
+        site = IndexingMemo.site(self)
         library = site.library
         original_entry = self.entry
         ds = {
@@ -1065,6 +1233,165 @@ class DataSource(models.Model):
             ds['public'] = True
         return ds
 
+def full_text_store():
+    return TextStore(settings.FULL_TEXT_STORE)
+
+def prune_full_texts(min_age=24 * 60 * 60, chunk_size=1000):
+    # the texts younger than min_age seconds are kept, a harvest
+    # could be about to record them
+    store = full_text_store()
+    removed = 0
+
+    def prune_chunk(chunk):
+        used = set(FullText.objects.filter(sha256__in=chunk).values_list('sha256', flat=True))
+        for digest in chunk:
+            if digest not in used:
+                store.remove(digest)
+        return len(chunk) - len(used)
+
+    chunk = []
+    for digest in store.digests(modified_before=time.time() - min_age):
+        chunk.append(digest)
+        if len(chunk) >= chunk_size:
+            removed += prune_chunk(chunk)
+            chunk = []
+    if chunk:
+        removed += prune_chunk(chunk)
+    return removed
+
+_indexing_memo = contextvars.ContextVar('indexing_memo', default=None)
+
+class IndexingMemo:
+    # the fragments of the data sources and the sites, built once
+    # for each indexing run: an issue of a journal is embedded in
+    # each of its articles. It assumes the data sources don't change,
+    # so it must not outlive the run.
+
+    def __init__(self):
+        self.fragments = {}
+        self.sites = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        self.token = _indexing_memo.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _indexing_memo.reset(self.token)
+        return False
+
+    @staticmethod
+    def fragment(data_source):
+        memo = _indexing_memo.get()
+        if memo is None:
+            return data_source.indexing_data()
+        # shared by the records, don't modify it
+        fragment = memo.fragments.get(data_source.id)
+        if fragment is None:
+            memo.misses += 1
+            fragment = memo.fragments[data_source.id] = data_source.indexing_data()
+        else:
+            memo.hits += 1
+        return fragment
+
+    @staticmethod
+    def site(data_source):
+        memo = _indexing_memo.get()
+        # with a select_related() the site is already there
+        if memo is not None and not DataSource.site.is_cached(data_source):
+            site = memo.sites.get(data_source.site_id)
+            if site is None:
+                site = memo.sites[data_source.site_id] = Site.objects.select_related('library').get(pk=data_source.site_id)
+            data_source.site = site
+        return data_source.site
+
+class QueryCounter:
+    # for connection.execute_wrapper()
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+def with_full_texts(entries, profile=None, processes=1):
+    # each entry as soon as its stale full texts are downloaded.
+    # The outcome is kept on the data sources, so they must be
+    # prefetched (see Entry.indexing_queryset).
+    waiting = {}
+    missing = {}
+    # don't keep more downloaded texts than this in memory
+    window = max(1, settings.FULL_TEXT_WORKERS // processes) * 4
+
+    def collect(futures):
+        for future in futures:
+            entry_id, ds, stored, url = waiting.pop(future)
+            try:
+                r = future.result()
+                if profile:
+                    profile.add(entry_id, 'fetch', r.elapsed.total_seconds(), size=len(r.content))
+            except requests.exceptions.RequestException as e:
+                r = e
+            # so indexing_data() doesn't retry a failure synchronously
+            ds.prefetched_full_text = ds.store_full_text(stored, url, r)
+            missing[entry_id][1] -= 1
+            if not missing[entry_id][1]:
+                yield missing.pop(entry_id)[0]
+
+    # the shards of a rebuild fetch at the same time, so each one gets
+    # its share of the limits
+    with HostLimitedFetcher(workers=max(1, settings.FULL_TEXT_WORKERS // processes),
+                            per_host=max(1, settings.FULL_TEXT_PER_HOST // processes),
+                            timeout=settings.FULL_TEXT_TIMEOUT,
+                            retries=settings.FULL_TEXT_RETRIES) as fetcher:
+        for entry in entries:
+            count = 0
+            for ds in entry.indexed_data_sources():
+                if ds.site.site_type == 'amusewiki' and ds.amusewiki_base_url():
+                    stored, stale = ds.full_text_state()
+                    if stale:
+                        url, headers = ds.full_text_request(stored)
+                        waiting[fetcher.get(url, headers)] = (entry.id, ds, stored, url)
+                        count += 1
+            if count:
+                missing[entry.id] = [ entry, count ]
+            else:
+                yield entry
+            while len(waiting) >= window:
+                finished, pending = wait(waiting, return_when=FIRST_COMPLETED)
+                yield from collect(finished)
+
+        # the rest, as they arrive
+        yield from collect(as_completed(list(waiting)))
+
+# local copy of the remote full texts, in the full_text_store()
+class FullText(models.Model):
+    data_source = models.OneToOneField(DataSource, on_delete=models.CASCADE, related_name="stored_full_text")
+    url = models.URLField(max_length=2048)
+    sha256 = models.CharField(max_length=64, db_index=True)
+    # validators for the conditional requests, as sent by the server
+    etag = models.CharField(max_length=255, null=True)
+    http_last_modified = models.CharField(max_length=64, null=True)
+    # when the text was last downloaded and last revalidated
+    fetched = models.DateTimeField()
+    checked = models.DateTimeField()
+
+    def text(self):
+        return full_text_store().get(self.sha256)
+
+    def exists(self):
+        return full_text_store().exists(self.sha256)
+
+    def is_fresh(self, datestamp=None):
+        # the harvest bumps the datestamp when the text changes
+        if datestamp and self.checked < datestamp:
+            return False
+        max_age = settings.FULL_TEXT_MAX_AGE
+        if max_age is not None and self.checked < datetime.now(timezone.utc) - timedelta(seconds=max_age):
+            return False
+        return True
+
 # linking table between entries for aggregations
 
 class AggregationEntry(models.Model):
@@ -1126,6 +1453,8 @@ class Harvest(models.Model):
     site = models.ForeignKey(Site, on_delete=models.CASCADE)
     datetime = models.DateTimeField()
     logs = models.TextField()
+    # IndexProfile summary and slowest entries of the indexing
+    stats = models.JSONField(null=True)
     def __str__(self):
         return self.site.title + ' Harvest ' + self.datetime.strftime('%Y-%m-%dT%H:%M:%SZ')
 
@@ -1195,6 +1524,24 @@ class Exclusion(models.Model):
             queries.append(('entry', self.exclude_entry_id))
         return queries
 
+    @classmethod
+    def xapian_queries_for_user(cls, user):
+        # not cached across requests: with more workers the invalidation
+        # would not reach the other processes. The compiled query is
+        # kept by the searcher.
+        queries = []
+        # a single query, no need to load the excluded objects
+        for library_id, author_id, entry_id in cls.objects.filter(user=user).values_list('exclude_library_id',
+                                                                                         'exclude_author_id',
+                                                                                         'exclude_entry_id'):
+            if library_id:
+                queries.append(('library', library_id))
+            if author_id:
+                queries.append(('creator', author_id))
+            if entry_id:
+                queries.append(('entry', entry_id))
+        return queries
+
 def spreadsheet_upload_directory(instance, filename):
     choices = "abcdefghijklmnopqrstuvwxyz0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
     return "spreadsheets/{0}-{1}.csv".format(int(datetime.now().timestamp()),
@@ -1273,6 +1620,74 @@ class ChangeLog(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     # last_modified = models.DateTimeField(auto_now=True)
 
+class ReindexJob(models.Model):
+    user = models.ForeignKey(
+        User,
+        null=True,
+        on_delete=models.SET_NULL,
+        related_name="reindex_jobs",
+    )
+    operation = models.CharField(max_length=64)
+    created = models.DateTimeField(auto_now_add=True)
+    completed = models.DateTimeField(null=True)
+
+    def as_api_dict(self):
+        return {
+            "id": self.id,
+            "operation": self.operation,
+            "created": self.created,
+            "completed": self.completed,
+            "pending": self.queued_entries.count(),
+        }
+
+# the outbox drained by the index_worker command
+class ReindexQueue(models.Model):
+    job = models.ForeignKey(ReindexJob, on_delete=models.CASCADE, related_name="queued_entries")
+    # not a FK, the entry could be gone by the time the worker runs
+    entry_id = models.IntegerField(db_index=True)
+
+def queue_reindex(entries, user=None, operation=""):
+    queue = [ ReindexQueue(entry_id=e.id) for e in entries ]
+    with transaction.atomic():
+        # nothing to wait for, the worker would never close it
+        job = ReindexJob.objects.create(user=user, operation=operation,
+                                        completed=None if queue else datetime.now(timezone.utc))
+        for item in queue:
+            item.job = job
+        ReindexQueue.objects.bulk_create(queue)
+    return job
+
+def process_reindex_queue(batch_size=1000):
+    # the oldest queued entries, once each, then the jobs with
+    # nothing left in the queue are closed
+    snapshot = ReindexQueue.objects.aggregate(Max('id'))['id__max']
+    if snapshot is None:
+        return 0
+    queued = ReindexQueue.objects.filter(id__lte=snapshot).order_by('id')
+    entry_ids = set([ q.entry_id for q in queued[:batch_size] ])
+    with IndexingMemo(), MycorrhizaIndexer(db_path=settings.XAPIAN_DB,
+                                           batch_size=settings.XAPIAN_INDEX_BATCH_SIZE,
+                                           on_commit=Entry.save_indexed_data) as indexer:
+        entries = Entry.indexing_queryset().in_bulk(entry_ids)
+        for eid in sorted(entry_ids):
+            if eid not in entries:
+                logger.info("Entry id {} not found?!".format(eid))
+                indexer.skip()
+        indexer.index_entries(with_full_texts(entries.values()))
+    logger.info(indexer.summary())
+    # the copies queued before the snapshot are covered as well. The
+    # ones queued later need another pass, the entry could have
+    # changed after we read it.
+    done = queued.filter(entry_id__in=entry_ids)
+    job_ids = set(done.values_list('job_id', flat=True))
+    done.delete()
+    # only the jobs we worked on: a job without queued entries could
+    # still be waiting for them
+    ReindexJob.objects.filter(id__in=job_ids,
+                              completed__isnull=True,
+                              queued_entries__isnull=True).update(completed=datetime.now(timezone.utc))
+    return len(entry_ids)
+
 # main router for user operations which need logging.
 def manipulate(op, user, main_id, *ids, create=None):
     out = {
@@ -1405,10 +1820,17 @@ def manipulate(op, user, main_id, *ids, create=None):
     else:
         raise Exception("Bug! Missing handler for " + op)
 
-    if reindex:
+    if reindex and settings.XAPIAN_INDEX_IN_BACKGROUND:
+        job = queue_reindex(reindex, user=user, operation=op)
+        logger.info("Queued reindex job {}".format(job.id))
+        out['reindex_job'] = job.id
+    elif reindex:
         logger.info("Reindexing")
-        indexer = MycorrhizaIndexer(db_path=settings.XAPIAN_DB)
-        indexer.index_entries(reindex)
+        with IndexingMemo(), MycorrhizaIndexer(db_path=settings.XAPIAN_DB,
+                                               batch_size=settings.XAPIAN_INDEX_BATCH_SIZE,
+                                               on_commit=Entry.save_indexed_data) as indexer:
+            indexer.index_entries(reindex)
         logger.info(indexer.logs)
+        logger.info(indexer.summary())
 
     return out
@@ -1,14 +1,35 @@
 from pathlib import Path
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.urls import reverse
-from .models import Entry, Agent, Site, DataSource, Library, Language, AggregationEntry
-from datetime import datetime, timezone
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from .models import Entry, Agent, Site, DataSource, Library, Language, AggregationEntry, Exclusion
+from .models import AggregationDataSource, IndexingMemo
+from .models import ReindexJob, ReindexQueue, queue_reindex, process_reindex_queue
+from .models import FullText, full_text_store, prune_full_texts, with_full_texts, Harvest
+from datetime import datetime, timezone, timedelta
 from amwmeta.harvest import extract_fields
-from amwmeta.xapian import search
+from amwmeta.xapian import search, suggest, get_searcher, MycorrhizaIndexer, index_shards, shard_path, merge_shards, merge_shard_labels
+from amwmeta.xapian import index_generations, current_generation, rollback_generation, index_stats
+from collector.management.commands.harvest import build_shard, rebuild_index
+from collector.management.commands.index_maintenance import check_index, repair_index, compact_index
+from .cache import get_search_cache, LocalResultCache
 import copy
+import csv
+import fcntl
+import json
+import os
 import pprint
 import shutil
+import tempfile
+import threading
+import time
+import unittest
 from django.contrib.auth.models import User
+from django.http import QueryDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 pp = pprint.PrettyPrinter(indent=4)
 
 xapian_test_db = Path('xapian', 'tests')
@@ -24,6 +45,7 @@ class ViewsTestCase(TestCase):
         password = 'password'
         User.objects.create_superuser('admin', 'admin@test.com', password)
 
+    @override_settings(XAPIAN_INDEX_IN_BACKGROUND=True)
     def test_api_create(self):
         data = {
             "value": "test",
@@ -97,6 +119,11 @@ class ViewsTestCase(TestCase):
                                    data=data,
                                    content_type="application/json")
             # pp.pprint(res.json())
+            job_id = res.json()['reindex_job']
+            process_reindex_queue()
+            res = self.client.get(reverse('api_reindex_job', args=[job_id]))
+            self.assertTrue(res.json()['completed'])
+            self.assertEqual(res.json()['pending'], 0)
             found_rel = AggregationEntry.objects.get(aggregated_id=entry.id, aggregation_id = eid)
             self.assertTrue(found_rel)
             res = self.client.get(reverse('api'), { "query": "Pizzosa" })
@@ -114,7 +141,7 @@ class AliasesTestCase(TestCase):
                                       checksum="XX")
         entrya.authors.set([ pinco ])
         entryb = Entry.objects.create(title="Pizzab",
-                                      checksum="XX")
+                                      checksum="XY")
         entryb.authors.set([ pincu ])
         entrya.canonical_entry = entryb
         entrya.save()
@@ -311,3 +338,824 @@ class AggregationProcessingTestCase(TestCase):
         self.assertEqual(DataSource.objects.filter(is_aggregation=True).count(), 2)
         # for entry in Entry.objects.filter(is_aggregation=True).all():
             # pp.pprint(entry.indexing_data())
+
+def create_test_site(name="Test", url="https://name.org", **kwargs):
+    library = Library.objects.create(
+        name=name,
+        url=url,
+        public=True,
+        active=True,
+    )
+    return Site.objects.create(
+        library=library,
+        title=name,
+        url=url,
+        **kwargs,
+    )
+
+def create_test_entry(site, title, checksum=None, **kwargs):
+    # an entry with a single data source
+    entry = Entry.objects.create(title=title, checksum=checksum or title, **kwargs)
+    DataSource.objects.create(
+        site=site,
+        oai_pmh_identifier=checksum or title,
+        datestamp=datetime.now(timezone.utc),
+        entry=entry,
+        is_aggregation=entry.is_aggregation,
+        full_data={},
+    )
+    return entry
+
+@override_settings(XAPIAN_DB=str(xapian_test_db))
+class IndexTestCase(TestCase):
+    def setUp(self):
+        self.site = create_test_site()
+
+    def add_entry(self, title):
+        entry = create_test_entry(self.site, title)
+        with MycorrhizaIndexer(db_path=str(xapian_test_db)) as indexer:
+            indexer.index_entries([ entry ])
+        return entry
+
+    def search_count(self, params, db_path=xapian_test_db):
+        libs = [ self.site.library_id ]
+        return len(search(str(db_path), params, active_libraries=libs, matches_only=True))
+
+class SearchTestCase(IndexTestCase):
+    def test_reopen(self):
+        params = { "query": "rhinoceros" }
+        self.add_entry("Rhinoceros")
+        self.assertEqual(self.search_count(params), 1)
+        searcher = get_searcher(str(xapian_test_db))
+        revision = searcher.revision()
+
+        self.add_entry("White rhinoceros")
+        self.assertEqual(self.search_count(params), 2)
+        self.assertIs(get_searcher(str(xapian_test_db)), searcher, "Handle is reused")
+        self.assertGreater(searcher.revision(), revision)
+
+    def test_cursor(self):
+        titles = [ "Okapi {}".format(x) for x in ("e", "b", "d", "a", "c") ]
+        for title in titles:
+            self.add_entry(title)
+        libs = [ self.site.library_id ]
+        for direction in ("asc", "desc"):
+            found = []
+            cursor = None
+            for page in range(10):
+                params = QueryDict(mutable=True)
+                params.update({
+                    "query": "okapi",
+                    "sort_by": "title",
+                    "sort_direction": direction,
+                    "page_size": 2,
+                })
+                if cursor:
+                    params['cursor'] = cursor
+                res = search(str(xapian_test_db), params, active_libraries=libs)
+                found.extend([ m['title'][0]['value'] for m in res['matches'] ])
+                cursor = res['next_cursor']
+                if not cursor:
+                    break
+            self.assertEqual(found, sorted(titles, reverse=(direction == "desc")))
+
+        params = QueryDict("query=okapi&cursor=xxx")
+        with self.assertRaises(ValueError):
+            search(str(xapian_test_db), params, active_libraries=libs)
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_export(self):
+        titles = [ "Wombat {}".format(x) for x in range(5) ]
+        for title in titles:
+            self.add_entry(title)
+        res = self.client.get(reverse('api_export', args=['jsonl']), { "query": "wombat" })
+        self.assertEqual(res.status_code, 200)
+        lines = b"".join(res.streaming_content).decode().splitlines()
+        self.assertEqual(sorted([ json.loads(l)['title'][0]['value'] for l in lines ]), titles)
+
+        res = self.client.get(reverse('api_export', args=['csv']), { "query": "wombat" })
+        rows = list(csv.reader(b"".join(res.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0][0], "entry_id")
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[1][6], "Test")
+
+        res = self.client.get(reverse('api_export', args=['xml']), { "query": "wombat" })
+        self.assertEqual(res.status_code, 404)
+
+class FacetTestCase(IndexTestCase):
+    def test_facets(self):
+        self.add_entry("Hippopotamus")
+        res = self.client.get(reverse('api'), { "query": "hippopotamus" })
+        facets = res.json()['facets']
+        self.assertEqual(facets['library']['values'][0]['id'], self.site.library_id)
+        self.assertEqual(facets['library']['values'][0]['term'], "Test")
+        self.assertEqual(facets['download']['values'][0]['id'], "none")
+
+    def test_facet_modes(self):
+        for title in ("Zebra", "Grevy zebra", "Plains zebra"):
+            self.add_entry(title)
+        libs = [ self.site.library_id ]
+        params = QueryDict("query=zebra")
+        res = search(str(xapian_test_db), params, active_libraries=libs, facet_mode='none')
+        self.assertEqual(res['facet_mode'], 'none')
+        self.assertEqual(res['facets'], {})
+        self.assertEqual(len(res['matches']), 3)
+
+        # everything fits in the sample, so the counts are exact
+        res = search(str(xapian_test_db), params, active_libraries=libs, facet_mode='sampled', checkatleast=100)
+        self.assertEqual(res['facet_mode'], 'exact')
+        self.assertEqual(res['facets']['library']['values'][0]['count'], 3)
+
+        with self.assertRaises(ValueError):
+            search(str(xapian_test_db), params, active_libraries=libs, facet_mode='pizza')
+
+    def test_sampled_facets(self):
+        sampled_db = Path('xapian', 'tests-sampled')
+        if sampled_db.is_dir():
+            shutil.rmtree(str(sampled_db))
+        entries = [ create_test_entry(self.site, "Quagga {}".format(i)) for i in range(8) ]
+        with MycorrhizaIndexer(db_path=str(sampled_db)) as indexer:
+            indexer.index_entries(entries)
+        libs = [ self.site.library_id ]
+
+        # a boolean query stops after checkatleast documents, and
+        # the counts of the sample are scaled to the estimate
+        params = QueryDict("")
+        res = search(str(sampled_db), params, active_libraries=libs, facet_mode='sampled', checkatleast=2, result='facets')
+        self.assertEqual(res['facet_mode'], 'sampled')
+        self.assertEqual(res['total_entries'], 8)
+        self.assertEqual(res['facets']['library']['values'][0]['count'], 8)
+        self.assertEqual(res['facets']['download']['values'][0]['count'], 8)
+
+        res = search(str(sampled_db), params, active_libraries=libs, facet_mode='exact', result='facets')
+        self.assertEqual(res['facet_mode'], 'exact')
+        self.assertEqual(res['facets']['library']['values'][0]['count'], 8)
+        shutil.rmtree(str(sampled_db))
+
+    def test_facets_and_count(self):
+        for title in ("Armadillo", "Giant armadillo"):
+            self.add_entry(title)
+        res = self.client.get(reverse('api_count'), { "query": "armadillo" }).json()
+        self.assertEqual(res['total_entries'], 2)
+        self.assertLessEqual(res['lower_bound'], 2)
+        self.assertGreaterEqual(res['upper_bound'], 2)
+        self.assertNotIn('facets', res)
+
+        res = self.client.get(reverse('api_facets'), { "query": "armadillo" }).json()
+        self.assertEqual(res['total_entries'], 2)
+        self.assertEqual(res['facets']['library']['values'][0]['count'], 2)
+        self.assertNotIn('matches', res)
+
+        res = self.client.get(reverse('api'), { "query": "armadillo", "result": "matches" }).json()
+        self.assertEqual(res['total_entries'], 2)
+        self.assertEqual(len(res['matches']), 2)
+        self.assertEqual(res['facets'], {})
+        res = self.client.get(reverse('api'), { "query": "armadillo", "result": "count" })
+        self.assertEqual(res.status_code, 400)
+
+class ResultCacheTestCase(IndexTestCase):
+    def test_result_cache(self):
+        self.add_entry("Giraffe")
+        cache = get_search_cache()
+        hits = cache.hits
+        res = self.client.get(reverse('api'), { "query": "giraffe" })
+        self.assertEqual(res.json()['total_entries'], 1)
+        res = self.client.get(reverse('api'), { "query": "giraffe", "unrelated": "x" })
+        self.assertEqual(res.json()['total_entries'], 1)
+        self.assertEqual(cache.hits, hits + 1)
+
+        # a commit changes the revision
+        self.add_entry("Baby giraffe")
+        res = self.client.get(reverse('api'), { "query": "giraffe" })
+        self.assertEqual(res.json()['total_entries'], 2)
+        self.assertEqual(cache.hits, hits + 1)
+
+        # the paging doesn't matter for the facets
+        res = self.client.get(reverse('api_facets'), { "query": "giraffe", "page_number": 1 })
+        self.assertEqual(res.json()['total_entries'], 2)
+        res = self.client.get(reverse('api_facets'), { "query": "giraffe", "page_number": 2, "cursor": "x" })
+        self.assertEqual(res.json()['total_entries'], 2)
+        self.assertEqual(cache.hits, hits + 2)
+
+    def test_local_cache_eviction(self):
+        cache = LocalResultCache(timeout=300, max_entries=2)
+        for key in ("a", "b", "c"):
+            cache.set(key, key)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("c"), "c")
+        cache = LocalResultCache(timeout=-1)
+        cache.set("a", "a")
+        self.assertIsNone(cache.get("a"), "Expired")
+
+class SuggestTestCase(IndexTestCase):
+    def test_suggest(self):
+        for title in ("Aardvark", "Aardvark and friends", "Aardwolf"):
+            self.add_entry(title)
+        res = self.client.get(reverse('api_suggest'), { "query": "AARD" })
+        values = [ s['value'] for s in res.json()['suggestions'] ]
+        self.assertEqual(sorted(values), [ "Aardvark", "Aardvark and friends", "Aardwolf" ])
+        res = self.client.get(reverse('api_suggest'), { "query": "a" })
+        self.assertEqual(res.json()['suggestions'], [], "Too short")
+        Library.objects.update(public=False)
+        self.add_entry("Aardvark again")
+        res = self.client.get(reverse('api_suggest'), { "query": "aardvark ag" })
+        self.assertEqual(res.json()['suggestions'], [], "Private")
+
+    def test_suggest_ranking(self):
+        entries = [ create_test_entry(self.site, "Abyssinian {}".format(x)) for x in ("a", "b", "c") ]
+        entries += [ create_test_entry(self.site, "Abyssinian cat", checksum="abyssinian-cat-{}".format(i)) for i in range(3) ]
+        with MycorrhizaIndexer(db_path=str(xapian_test_db)) as indexer:
+            indexer.index_entries(entries)
+        # the frequent completion sorts last, but comes first
+        libs = [ self.site.library_id ]
+        res = suggest(str(xapian_test_db), "abyss", limit=2, active_libraries=libs)
+        self.assertEqual(len(res), 2)
+        self.assertEqual(res[0]['value'], "Abyssinian cat")
+        self.assertEqual(res[0]['count'], 3)
+        self.assertEqual(res[1]['count'], 1)
+        self.assertEqual(suggest(str(xapian_test_db), "abyss", limit=2, active_libraries=[ 0 ]), [])
+
+    def test_suggest_inactive_library(self):
+        self.add_entry("Axolotl")
+        self.add_entry("Axolotl tales")
+        User.objects.create_user('suggester', 'suggester@test.com', 'password')
+        self.client.login(username="suggester", password="password")
+        Library.objects.update(active=False)
+        res = self.client.get(reverse('api_suggest'), { "query": "axolotl" })
+        self.assertEqual(res.json()['suggestions'], [], "Inactive library")
+        Library.objects.update(active=True)
+        res = self.client.get(reverse('api_suggest'), { "query": "axolotl" })
+        self.assertEqual(len(res.json()['suggestions']), 2)
+
+class IndexingSessionTestCase(IndexTestCase):
+    def test_indexing_session(self):
+        entries = [ create_test_entry(self.site, title) for title in ("Pangolin", "Giant pangolin", "Tree pangolin") ]
+        with MycorrhizaIndexer(db_path=str(xapian_test_db), batch_size=2) as indexer:
+            indexer.index_entries(entries)
+        self.assertEqual(indexer.counters['written'], 3)
+        self.assertEqual(indexer.counters['commits'], 2)
+
+        params = { "query": "pangolin" }
+        self.assertEqual(self.search_count(params), 3)
+
+        # the pending batch is cancelled on failure
+        entry = create_test_entry(self.site, "Pangolin again", checksum="pangolin-again")
+        with self.assertRaises(ZeroDivisionError):
+            with MycorrhizaIndexer(db_path=str(xapian_test_db)) as indexer:
+                indexer.index_entries([ entry ])
+                1 / 0
+        self.assertEqual(self.search_count(params), 3)
+
+    def test_harvest_stats(self):
+        entry = create_test_entry(self.site, "Okapi", checksum="okapi")
+        self.site.index_harvested_records([ entry.id, entry.id ], now=datetime.now(timezone.utc))
+        stats = Harvest.objects.get(site=self.site).stats
+        self.assertEqual(stats['entries'], 1)
+        self.assertTrue(stats['queries'] > 0)
+        for stage in ('data', 'terms', 'write', 'commit'):
+            self.assertIn(stage, stats['stages'])
+        self.assertEqual(stats['slowest'][0]['entry_id'], entry.id)
+
+    def test_skip_unchanged(self):
+        entry = create_test_entry(self.site, "Tapir", checksum="tapir")
+        last_modified = entry.last_modified
+        with MycorrhizaIndexer(db_path=str(xapian_test_db), on_commit=Entry.save_indexed_data) as indexer:
+            indexer.index_entries([ entry ])
+        self.assertEqual(indexer.counters['written'], 1)
+        entry.refresh_from_db()
+        record_hash = entry.indexed_hash
+        self.assertTrue(record_hash)
+        self.assertEqual(entry.indexed_data['title'][0]['value'], "Tapir")
+        # only the indexed data columns are written
+        self.assertEqual(entry.last_modified, last_modified)
+
+        with MycorrhizaIndexer(db_path=str(xapian_test_db), on_commit=Entry.save_indexed_data) as indexer:
+            indexer.index_entries([ entry ])
+        self.assertEqual(indexer.counters['written'], 0)
+        self.assertEqual(indexer.counters['unchanged'], 1)
+        entry.refresh_from_db()
+        # not saved either
+        self.assertEqual(entry.last_modified, last_modified)
+
+        with MycorrhizaIndexer(db_path=str(xapian_test_db), force=True) as indexer:
+            indexer.index_entries([ entry ])
+        self.assertEqual(indexer.counters['written'], 1)
+
+        entry.title = "Mountain tapir"
+        entry.save()
+        with MycorrhizaIndexer(db_path=str(xapian_test_db), on_commit=Entry.save_indexed_data) as indexer:
+            indexer.index_entries([ entry ])
+        self.assertEqual(indexer.counters['written'], 1)
+        entry.refresh_from_db()
+        self.assertNotEqual(entry.indexed_hash, record_hash)
+
+    def test_index_layouts(self):
+        layout_db = Path('xapian', 'tests-layout')
+        if layout_db.is_dir():
+            shutil.rmtree(str(layout_db))
+        entry = create_test_entry(self.site, "Okapi", checksum="okapi")
+        with self.assertRaises(ValueError):
+            MycorrhizaIndexer(db_path=str(layout_db), index_layout="pizza")
+        with MycorrhizaIndexer(db_path=str(layout_db), index_layout="metadata") as indexer:
+            indexer.index_entries([ entry ])
+        self.assertEqual(indexer.counters['written'], 1)
+
+        # the incremental updates follow the layout of the index
+        with MycorrhizaIndexer(db_path=str(layout_db), force=True) as indexer:
+            self.assertEqual(indexer.index_layout, "metadata")
+            self.assertFalse(indexer.index_fields['full_text'].get('index', True))
+            indexer.index_entries([ entry ])
+
+        self.assertEqual(self.search_count({ "query": "okapi" }, db_path=layout_db), 1)
+        shutil.rmtree(str(layout_db))
+
+class ReindexQueueTestCase(IndexTestCase):
+    def test_reindex_queue(self):
+        entry = create_test_entry(self.site, "Narwhal", checksum="narwhal")
+        other = Entry.objects.create(title="Beluga", checksum="beluga")
+        first = queue_reindex([ entry, other ], operation="merge-entries")
+        second = queue_reindex([ entry ], operation="merge-entries")
+        other.delete()
+        self.assertEqual(ReindexQueue.objects.count(), 3)
+
+        # each entry once
+        self.assertEqual(process_reindex_queue(), 2)
+        self.assertEqual(ReindexQueue.objects.count(), 0)
+        for job in (first, second):
+            job.refresh_from_db()
+            self.assertTrue(job.completed)
+        self.assertEqual(process_reindex_queue(), 0)
+
+        # a worker running between the creation of a job and of its
+        # queue leaves it open
+        job = ReindexJob.objects.create(operation="merge-entries")
+        self.assertEqual(process_reindex_queue(), 0)
+        queue_reindex([ entry ], operation="merge-entries")
+        self.assertEqual(process_reindex_queue(), 1)
+        job.refresh_from_db()
+        self.assertIsNone(job.completed)
+        ReindexQueue.objects.create(job=job, entry_id=entry.id)
+        self.assertEqual(process_reindex_queue(), 1)
+        job.refresh_from_db()
+        self.assertTrue(job.completed)
+        self.assertTrue(queue_reindex([], operation="merge-entries").completed)
+
+        self.assertEqual(self.search_count({ "query": "narwhal" }), 1)
+
+class IndexRebuildTestCase(IndexTestCase):
+    def test_shards(self):
+        shards_db = Path('xapian', 'tests-shards')
+        merged_db = Path('xapian', 'tests-merged')
+        for path in (shards_db, merged_db):
+            if path.is_dir():
+                shutil.rmtree(str(path))
+        shards_db.mkdir(parents=True)
+        for title in ("Red panda", "Giant panda", "Panda bear", "Kung fu panda"):
+            create_test_entry(self.site, title)
+        for shard in range(2):
+            built, counters, elapsed, profile = build_shard((shard_path(str(shards_db), shard), shard, 2, 10, 0, None))
+            self.assertEqual(built, shard)
+            self.assertEqual(counters['written'], 2)
+        shards = index_shards(str(shards_db))
+        self.assertEqual(len(shards), 2)
+        merge_shard_labels(shards)
+
+        libs = [ self.site.library_id ]
+        params = { "query": "panda" }
+        res = search(str(shards_db), params, active_libraries=libs)
+        self.assertEqual(res['pager'].total_entries, 4)
+        self.assertEqual(len(res['facets']['library']['values']), 1)
+
+        # updates go to the same shard
+        entry = Entry.objects.get(title="Red panda")
+        with MycorrhizaIndexer(db_path=str(shards_db)) as indexer:
+            indexer.index_entries([ entry ])
+        self.assertEqual(self.search_count(params, db_path=shards_db), 4)
+
+        merge_shards(shards, str(merged_db))
+        self.assertEqual(self.search_count(params, db_path=merged_db), 4)
+
+    def test_generations(self):
+        db_path = Path('xapian', 'tests-generations')
+        for path in (db_path, Path(str(db_path) + '.generations')):
+            if path.is_symlink():
+                path.unlink()
+            elif path.is_dir():
+                shutil.rmtree(str(path))
+        params = { "query": "walrus" }
+
+        # a plain directory is kept as the first generation
+        with MycorrhizaIndexer(db_path=str(db_path)) as indexer:
+            pass
+        self.assertEqual(self.search_count(params, db_path=db_path), 0)
+
+        self.add_entry("Walrus")
+        rebuild_index(str(db_path), keep_generations=2)
+        self.assertTrue(db_path.is_symlink())
+        self.assertEqual(len(index_generations(str(db_path))), 2)
+        self.assertEqual(self.search_count(params, db_path=db_path), 1)
+
+        self.add_entry("Walrus again")
+        rebuild_index(str(db_path), keep_generations=2)
+        generations = index_generations(str(db_path))
+        self.assertEqual(len(generations), 2)
+        self.assertEqual(current_generation(str(db_path)), str(Path(generations[-1]).resolve()))
+        self.assertEqual(self.search_count(params, db_path=db_path), 2)
+
+        rollback_generation(str(db_path))
+        self.assertEqual(self.search_count(params, db_path=db_path), 1)
+        with self.assertRaises(ValueError):
+            rollback_generation(str(db_path))
+
+        # the rebuild would lose the updates of the index worker
+        with open(str(db_path) + ".worker.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            with self.assertRaises(CommandError):
+                rebuild_index(str(db_path), keep_generations=2)
+        self.assertEqual(len(index_generations(str(db_path))), 2)
+
+        # a failing worker leaves no staging directory behind
+        generations = sorted(os.listdir(str(db_path) + '.generations'))
+        with self.assertRaises(ValueError):
+            rebuild_index(str(db_path), workers=2, index_layout="bogus")
+        self.assertEqual(sorted(os.listdir(str(db_path) + '.generations')), generations)
+
+    def test_harvest_force_locked(self):
+        db_path = str(xapian_test_db)
+        with open(db_path + ".worker.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # before harvesting anything
+            with self.assertRaises(CommandError):
+                call_command('harvest', force=True)
+        self.assertFalse(Harvest.objects.exists())
+
+    def test_index_maintenance(self):
+        db_path = Path('xapian', 'tests-maintenance')
+        for path in (db_path, Path(str(db_path) + '.generations')):
+            if path.is_symlink():
+                path.unlink()
+            elif path.is_dir():
+                shutil.rmtree(str(path))
+        entries = [ create_test_entry(self.site, title) for title in ("Ibex", "Alpine ibex", "Nubian ibex", "Walia ibex") ]
+        # an alias is not indexed as such, a merged aggregation is
+        Entry.objects.create(title="Ibex alias", checksum="ibex-alias", canonical_entry=entries[0])
+        merged = Entry.objects.create(title="Ibex anthology", checksum="ibex-anthology",
+                                      is_aggregation=True, canonical_entry=entries[0])
+        with MycorrhizaIndexer(db_path=str(db_path)) as indexer:
+            indexer.index_entries(entries[1:] + [ merged ])
+        stale = entries.pop()
+        stale_id = stale.id
+        stale.delete()
+
+        self.assertEqual(check_index(str(db_path), chunk_size=2), ([ stale_id ], [ entries[0].id ]))
+        counters = repair_index(str(db_path), [ stale_id ], [ entries[0].id ])
+        self.assertEqual(counters['written'], 1)
+        self.assertEqual(counters['deleted'], 1)
+        self.assertEqual(check_index(str(db_path)), ([], []))
+
+        compact_index(str(db_path), keep_generations=2)
+        self.assertTrue(db_path.is_symlink())
+        stats = index_stats(str(db_path))
+        self.assertEqual(stats['documents'], 4)
+        self.assertEqual(stats['terms']['Q']['terms'], 4)
+        self.assertGreater(stats['terms']['']['terms'], 0)
+        self.assertGreater(stats['size'], 0)
+
+        self.assertEqual(self.search_count({ "query": "ibex" }, db_path=db_path), 3)
+
+class IndexingDataTestCase(IndexTestCase):
+    def test_bulk_indexing_data(self):
+        language = Language.objects.create(code="en")
+        canonical = Agent.objects.create(name="Canonical lynx author")
+        anthology = create_test_entry(self.site, "Lynx anthology", checksum="lynx-anthology", is_aggregation=True)
+        anthology_ds = DataSource.objects.get(entry=anthology)
+        ids = [ anthology.id ]
+        for i in range(6):
+            title = "Lynx {}".format(i)
+            entry = create_test_entry(self.site, title, original_entry=anthology)
+            author = Agent.objects.create(name="Lynx author {}".format(i), canonical_agent=canonical)
+            entry.authors.add(author)
+            entry.languages.add(language)
+            create_test_entry(self.site, title + " variant", checksum=title + "-variant", canonical_entry=entry)
+            AggregationEntry.objects.create(aggregation=anthology, aggregated=entry)
+            AggregationDataSource.objects.create(aggregation=anthology_ds, aggregated=DataSource.objects.get(entry=entry), sorting_pos=i)
+            ids.append(entry.id)
+
+        with CaptureQueriesContext(connection) as few:
+            list(Entry.bulk_indexing_data(Entry.objects.filter(id__in=ids[:2])))
+        with CaptureQueriesContext(connection) as many:
+            records = list(Entry.bulk_indexing_data(Entry.objects.filter(id__in=ids)))
+        self.assertEqual(len(many), len(few), "The queries don't depend on the number of entries")
+        self.assertEqual(len(records), 7)
+
+        # the anthology fragment is built once for all the articles
+        with IndexingMemo() as memo:
+            with CaptureQueriesContext(connection) as memoized:
+                memo_records = list(Entry.bulk_indexing_data(Entry.objects.filter(id__in=ids)))
+        self.assertEqual(memo_records, records)
+        self.assertEqual(len(memoized), len(many))
+        # the articles of the anthology and the anthology in each article
+        self.assertEqual(memo.misses, 7)
+        self.assertEqual(memo.hits, 5)
+
+        # same as the entry by entry building, where the memo saves
+        # the queries as well
+        articles = [ Entry.objects.get(pk=i) for i in ids[1:] ]
+        with CaptureQueriesContext(connection) as plain:
+            plain_records = [ e.indexing_data() for e in articles ]
+        articles = [ Entry.objects.get(pk=i) for i in ids[1:] ]
+        with IndexingMemo(), CaptureQueriesContext(connection) as memoized:
+            self.assertEqual([ e.indexing_data() for e in articles ], plain_records)
+        self.assertLess(len(memoized), len(plain))
+
+        for record in records:
+            self.assertEqual(record, Entry.objects.get(pk=record['entry_id']).indexing_data())
+            if record['entry_id'] == anthology.id:
+                self.assertEqual([ agg['title'] for agg in record['data_sources'][0]['aggregated'] ],
+                                 [ "Lynx {}".format(i) for i in range(6) ])
+            else:
+                self.assertEqual(len(record['data_sources']), 2)
+                self.assertEqual(record['creator'][0]['id'], canonical.id)
+
+    def test_save_indexed_data(self):
+        entry = create_test_entry(self.site, "Quokka", checksum="quokka")
+        last_modified = entry.last_modified
+        record = entry.indexing_data()
+        self.assertTrue(entry.indexed_data_changed)
+        self.assertEqual(Entry.save_indexed_data([ entry ]), 1)
+        self.assertEqual(Entry.save_indexed_data([ entry ]), 0)
+        entry.refresh_from_db()
+        self.assertEqual(entry.indexed_hash, record['record_hash'])
+        self.assertEqual(entry.indexed_data['entry_id'], entry.id)
+        self.assertNotIn('full_texts', entry.indexed_data)
+        self.assertEqual(entry.last_modified, last_modified)
+        entry.indexing_data()
+        self.assertFalse(entry.indexed_data_changed)
+        # the last modification date is indexed too
+        Entry.objects.filter(pk=entry.pk).update(last_modified=last_modified + timedelta(minutes=1))
+        entry.refresh_from_db()
+        entry.indexing_data()
+        self.assertTrue(entry.indexed_data_changed)
+
+class ExclusionCacheTestCase(TestCase):
+    def test_cache(self):
+        user = User.objects.create_user('excluder', 'excluder@test.com', 'password')
+        library = Library.objects.create(name="Excluded")
+        agent = Agent.objects.create(name="Excluded Author")
+        Exclusion.objects.create(user=user, exclude_library=library, comment="x")
+        with self.assertNumQueries(1):
+            self.assertEqual(Exclusion.xapian_queries_for_user(user), [ ('library', library.id) ])
+        # changes made by another process are seen at once
+        exclusion = Exclusion(user=user, exclude_author=agent, comment="x")
+        Exclusion.objects.bulk_create([ exclusion ])
+        exclusion = Exclusion.objects.get(user=user, exclude_author=agent)
+        with self.assertNumQueries(1):
+            self.assertEqual(sorted(Exclusion.xapian_queries_for_user(user)),
+                             [ ('creator', agent.id), ('library', library.id) ])
+        exclusion.delete()
+        self.assertEqual(Exclusion.xapian_queries_for_user(user), [ ('library', library.id) ])
+
+@override_settings(FULL_TEXT_STORE=str(Path('xapian', 'tests-texts')))
+class FullTextStoreTestCase(TestCase):
+    def setUp(self):
+        # the texts outlive the rolled back rows
+        shutil.rmtree(str(Path('xapian', 'tests-texts')), ignore_errors=True)
+
+    def test_stored_text(self):
+        site = create_test_site(site_type="amusewiki")
+        entry = Entry.objects.create(title="Stored", checksum="stored")
+        ds = DataSource.objects.create(
+            site=site,
+            oai_pmh_identifier="stored",
+            datestamp=datetime(2024, 1, 1, tzinfo=timezone.utc),
+            entry=entry,
+            uri="https://name.org/library/stored",
+            full_data={},
+        )
+        now = datetime.now(timezone.utc)
+        FullText.objects.create(
+            data_source=ds,
+            url="https://name.org/library/stored.bare.html",
+            sha256=full_text_store().put("<p>Stored text</p>"),
+            etag='"x"',
+            fetched=now,
+            checked=now,
+        )
+        # fresh, so no request
+        self.assertEqual(ds.full_text(), "<p>Stored text</p>")
+        stored = ds.stored_text()
+        self.assertTrue(stored.is_fresh(ds.datestamp))
+        self.assertFalse(stored.is_fresh(now + timedelta(days=1)))
+        with self.settings(FULL_TEXT_MAX_AGE=60):
+            stored.checked = now - timedelta(days=1)
+            self.assertFalse(stored.is_fresh())
+
+        res = self.client.get(reverse('api_full_text', args=[ds.id]))
+        self.assertEqual(res.json()['html'], "<p>Stored text</p>")
+        etag = res['ETag']
+        res = self.client.get(reverse('api_full_text', args=[ds.id]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+
+        orphan = full_text_store().put("<p>Orphan text</p>")
+        self.assertEqual(prune_full_texts(), 0, "Too recent")
+        self.assertEqual(prune_full_texts(min_age=0), 1)
+        self.assertFalse(full_text_store().exists(orphan))
+        self.assertEqual(ds.full_text(), "<p>Stored text</p>")
+
+        # nothing to show, so nothing to validate either
+        empty = full_text_store().put("")
+        FullText.objects.filter(data_source=ds).update(sha256=empty)
+        res = self.client.get(reverse('api_full_text', args=[ds.id]), HTTP_IF_NONE_MATCH='"{}"'.format(empty))
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('ETag', res)
+
+    def test_failed_prefetch(self):
+        requests_seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests_seen.append(self.path)
+                self.send_response(404)
+                self.end_headers()
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = "http://127.0.0.1:{}".format(server.server_port)
+        site = create_test_site(name="Missing", url=base, site_type="amusewiki")
+        entry = Entry.objects.create(title="Missing", checksum="missing")
+        DataSource.objects.create(
+            site=site,
+            oai_pmh_identifier="missing",
+            datestamp=datetime.now(timezone.utc),
+            entry=entry,
+            uri=base + "/library/missing",
+            full_data={},
+        )
+        try:
+            for entry in with_full_texts(Entry.indexing_queryset(Entry.objects.filter(id=entry.id))):
+                self.assertEqual(requests_seen, [ "/library/missing.bare.html" ])
+                entry.indexing_data()
+                self.assertEqual(len(requests_seen), 1, "Not retried by indexing_data")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    @override_settings(FULL_TEXT_WORKERS=8, FULL_TEXT_PER_HOST=4)
+    def test_shard_host_limit(self):
+        running = [ 0, 0 ]
+        lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with lock:
+                    running[0] += 1
+                    running[1] = max(running)
+                time.sleep(0.05)
+                with lock:
+                    running[0] -= 1
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b"<p>Text</p>")
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = "http://127.0.0.1:{}".format(server.server_port)
+        site = create_test_site(name="Shards", url=base, site_type="amusewiki")
+        for i in range(12):
+            entry = Entry.objects.create(title="Shard {}".format(i), checksum="shard-{}".format(i))
+            DataSource.objects.create(
+                site=site,
+                oai_pmh_identifier="shard-{}".format(i),
+                datestamp=datetime.now(timezone.utc),
+                entry=entry,
+                uri=base + "/library/shard-{}".format(i),
+                full_data={},
+            )
+        try:
+            # one of two shards, which run at the same time
+            entries = list(with_full_texts(Entry.indexing_queryset(), processes=2))
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(len(entries), 12)
+        self.assertLessEqual(running[1], 2)
+        self.assertEqual(FullText.objects.count(), 12)
+
+class CalibreManifestTestCase(TestCase):
+    def test_manifest(self):
+        library = Library.objects.create(name="Calibre", public=True, active=True)
+        site = Site.objects.create(library=library, title="Calibre", site_type="calibretree")
+        with tempfile.TemporaryDirectory() as book:
+            for name in ("book.pdf", "book.epub", "book.txt"):
+                Path(book, name).write_text("Some <text>")
+            ds = DataSource.objects.create(
+                site=site,
+                oai_pmh_identifier="calibre-book",
+                uri=book,
+                full_data={},
+            )
+            # built on the first use
+            self.assertEqual([ d['ext'] for d in ds.download_options() ], [ '.epub', '.pdf', '.txt' ])
+            ds = DataSource.objects.select_related('site').get(pk=ds.id)
+            self.assertEqual(len(ds.file_manifest['files']), 3)
+            with self.assertNumQueries(0):
+                self.assertEqual(len(ds.download_options()), 3)
+                self.assertEqual(ds.full_text(), "Some &lt;text&gt;")
+
+            # removed after the scan
+            Path(book, "book.pdf").unlink()
+            mtime = ds.file_manifest['mtime'] + 10**9
+            os.utime(book, ns=(mtime, mtime))
+            self.assertEqual([ d['ext'] for d in ds.download_options() ], [ '.epub', '.txt' ])
+            self.assertIsNone(ds.get_calibre_file('.pdf'))
+            self.assertEqual(ds.get_calibre_file('.epub'), Path(book, "book.epub"))
+            ds.refresh_from_db()
+            self.assertEqual(len(ds.file_manifest['files']), 2)
+
+class HarvestQueriesTestCase(TestCase):
+    # the queries of each record, so a new lookup in the hot path
+    # shows up. HARVEST_BENCHMARK_ENTRIES sets the size of the database,
+    # HARVEST_BENCHMARK_BUDGET the seconds allowed for each record.
+
+    entries = int(os.environ.get('HARVEST_BENCHMARK_ENTRIES', 1000))
+    budget = float(os.environ.get('HARVEST_BENCHMARK_BUDGET', 0))
+
+    def setUp(self):
+        library = Library.objects.create(name="Bench", public=True, active=True)
+        self.site = Site.objects.create(library=library, title="Bench", url="https://bench.org")
+        now = datetime.now(timezone.utc)
+        for start in range(0, self.entries, 5000):
+            chunk = range(start, min(start + 5000, self.entries))
+            entries = Entry.objects.bulk_create([ Entry(title="Bench {}".format(i), checksum="bench-{}".format(i))
+                                                  for i in chunk ])
+            DataSource.objects.bulk_create([ DataSource(site=self.site,
+                                                        oai_pmh_identifier="oai:bench.org:{}".format(e.checksum),
+                                                        datestamp=now,
+                                                        entry=e,
+                                                        full_data={}) for e in entries ])
+
+    def record(self, name, aggregation=None):
+        record = {
+            "identifier": "oai:bench.org:" + name,
+            "title": name,
+            "checksum": "harvested-" + name,
+            "authors": [ "Harvested Author" ],
+            "languages": [ "en" ],
+            "uri": "https://bench.org/library/" + name,
+            "full_data": {},
+            "deleted": False,
+            "datestamp": datetime.now(timezone.utc),
+            "aggregations": [],
+        }
+        if aggregation:
+            record['aggregations'].append({
+                "full_aggregation_name": aggregation,
+                "identifier": "oai:bench.org:aggregation:" + aggregation,
+                "checksum": "harvested-aggregation-" + aggregation,
+                "order": 1,
+            })
+        return record
+
+    def process(self, record):
+        now = datetime.now(timezone.utc)
+        with CaptureQueriesContext(connection) as queries:
+            self.site.process_harvested_record(record, self.site.record_aliases(), now)
+        return len(queries)
+
+    def test_queries(self):
+        # new author and language
+        self.assertEqual(self.process(self.record("first")), 21)
+        self.assertEqual(self.process(self.record("first")), 8)
+        self.assertEqual(self.process(self.record("second")), 15)
+        # the aggregation is an entry and a data source of its own
+        self.assertEqual(self.process(self.record("article", aggregation="issue")), 34)
+        self.assertEqual(self.process(self.record("article", aggregation="issue")), 16)
+        self.assertEqual(self.process(self.record("other article", aggregation="issue")), 29)
+        self.assertEqual(Entry.objects.filter(checksum="harvested-aggregation-issue").count(), 1)
+
+        # the same record again: nothing to write
+        record = self.record("unchanged")
+        self.process(copy.deepcopy(record))
+        entry = Entry.objects.get(checksum="harvested-unchanged")
+        ds = DataSource.objects.get(entry=entry)
+        # the lookups only, no update
+        self.assertEqual(self.process(copy.deepcopy(record)), 6)
+        self.assertEqual(Entry.objects.get(pk=entry.pk).last_modified, entry.last_modified)
+        self.assertEqual(DataSource.objects.get(pk=ds.pk).last_modified, ds.last_modified)
+
+    @unittest.skipUnless(os.environ.get('HARVEST_BENCHMARK_BUDGET'), "Set HARVEST_BENCHMARK_BUDGET to time the harvest")
+    def test_timing(self):
+        records = [ self.record("timed {}".format(i), aggregation="issue {}".format(i % 5)) for i in range(50) ]
+        started = time.perf_counter()
+        for record in records:
+            self.process(record)
+        # and again, unchanged
+        for record in [ self.record("timed {}".format(i), aggregation="issue {}".format(i % 5)) for i in range(50) ]:
+            self.process(record)
+        elapsed = (time.perf_counter() - started) / 100
+        self.assertLess(elapsed, self.budget,
+                        "{:.4f}s per record with {} entries".format(elapsed, self.entries))
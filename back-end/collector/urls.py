@@ -4,6 +4,11 @@ from . import views
 
 urlpatterns = [
     path("api", views.api, name="api"),
+    path("api/facets", views.api_facets, name="api_facets"),
+    path("api/count", views.api_count, name="api_count"),
+    path("api/stats/search-cache", views.api_search_cache_stats, name="api_search_cache_stats"),
+    path("api/export/<export_format>", views.api_export, name="api_export"),
+    path("api/suggest", views.api_suggest, name="api_suggest"),
     path("api/auth/login", views.api_login, name="api_login"),
     path("api/auth/logout", views.api_logout, name="api_logout"),
     path("api/auth/reset-password", views.api_reset_password, name="api_reset_password"),
@@ -18,6 +23,7 @@ urlpatterns = [
     path("api/revert/<target>", views.api_revert, name="api_revert"),
     path("api/set-translations", views.api_set_translations, name="api_set_translations"),
     path("api/set-aggregated", views.api_set_aggregated, name="api_set_aggregated"),
+    path("api/reindex-job/<int:job_id>", views.api_reindex_job, name="api_reindex_job"),
     path("api/exclusions", views.exclusions, name="exclusions"),
     path("api/create/<target>", views.api_create, name="api_create"),
     path("api/library/<action>/<int:library_id>", views.api_library_action, name="api_library_action"),
@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 from django.core.exceptions import ValidationError
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponse, JsonResponse, HttpResponseRedirect, Http404
+from django.http import HttpResponse, JsonResponse, HttpResponseRedirect, Http404, StreamingHttpResponse, HttpResponseNotModified
+from django.utils.http import http_date
 from django.template import loader
 import json
-from amwmeta.xapian import search
+from amwmeta.xapian import search, search_all, suggest, matches_json
 import logging
 from django.urls import reverse
 from django.conf import settings
@@ -14,9 +15,10 @@ from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.password_validation import validate_password, password_validators_help_texts
 from django.db.models import Q
-from .models import Profile, Entry, Agent, Site, SpreadsheetUpload, DataSource, Library, Exclusion, AggregationEntry, ChangeLog, manipulate, log_user_operation
+from .models import Profile, Entry, Agent, Site, SpreadsheetUpload, DataSource, Library, Exclusion, AggregationEntry, ChangeLog, ReindexJob, manipulate, log_user_operation
 from django.contrib.auth.models import User
 from amwmeta.xapian import MycorrhizaIndexer
+from .cache import get_search_cache, search_cache_key
 from django.contrib import messages
 from django.contrib.syndication.views import Feed
 from django.core.mail import send_mail
@@ -26,6 +28,8 @@ from urllib.parse import urlparse
 from datetime import datetime, timedelta, timezone
 import re
 import requests
+import csv
+import itertools
 # from django.db import connection
 import pprint
 pp = pprint.PrettyPrinter(indent=2)
@@ -192,30 +196,56 @@ def _active_libraries(user):
     logger.debug("Active libs are {}".format(active_libraries))
     return active_libraries
 
-def api(request):
-    public_only = True
-
-    user = request.user
+def _search_restrictions(user):
     active_libraries = _active_libraries(user)
     logger.debug("User libraries: {}".format(active_libraries))
-
     exclusions = []
-    can_set_exclusions = False
     if user.is_authenticated:
-        exclusions = []
-        for exclusion in user.exclusions.all():
-            exclusions.extend(exclusion.as_xapian_queries())
+        exclusions = Exclusion.xapian_queries_for_user(user)
         logger.debug("Exclusions: {}".format(exclusions))
-        can_set_exclusions = True
+    return (active_libraries, exclusions)
+
+def _cached_search(request, active_libraries, exclusions, result='full'):
+    cache = get_search_cache()
+    if cache:
+        cache_key = search_cache_key(settings.XAPIAN_DB, request.GET, active_libraries, exclusions, extra=result)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
 
     res = search(
         settings.XAPIAN_DB,
         request.GET,
         active_libraries=active_libraries,
         exclusions=exclusions,
+        facet_mode=settings.XAPIAN_FACET_MODE,
+        checkatleast=settings.XAPIAN_FACET_CHECKATLEAST,
+        raw_matches=True,
+        result=result,
     )
-    res['total_entries'] = res['pager'].total_entries
-    res['pager'] = page_list(res['pager'])
+    if res.get('pager'):
+        res['total_entries'] = res['pager'].total_entries
+        res['pager'] = page_list(res['pager'])
+    if cache:
+        cache.set(cache_key, res)
+    return res
+
+def api(request):
+    user = request.user
+    active_libraries, exclusions = _search_restrictions(user)
+
+    # result=matches skips the facets, see api_facets
+    result = request.GET.get('result', 'full')
+    if result not in ('full', 'matches'):
+        return JsonResponse({ "error": "Invalid result " + result }, status=HTTPStatus.BAD_REQUEST)
+    try:
+        cached = _cached_search(request, active_libraries, exclusions, result=result)
+    except ValueError as error:
+        # e.g. a bogus cursor
+        return JsonResponse({ "error": str(error) }, status=HTTPStatus.BAD_REQUEST)
+
+    # the user specific values must not end up in the cache
+    res = dict(cached)
     res['is_authenticated'] = user.is_authenticated
     res['can_set_exclusions'] = user.is_superuser
     res['can_merge'] = user.is_superuser
@@ -226,8 +256,115 @@ def api(request):
         res['can_set_exclusions'] = True
         res['can_merge'] = profile.can_merge_entries()
 
+    return _search_response(res)
+
+def api_facets(request):
+    active_libraries, exclusions = _search_restrictions(request.user)
+    try:
+        res = _cached_search(request, active_libraries, exclusions, result='facets')
+    except ValueError as error:
+        return JsonResponse({ "error": str(error) }, status=HTTPStatus.BAD_REQUEST)
+    return JsonResponse(res)
+
+def api_count(request):
+    active_libraries, exclusions = _search_restrictions(request.user)
+    try:
+        res = _cached_search(request, active_libraries, exclusions, result='count')
+    except ValueError as error:
+        return JsonResponse({ "error": str(error) }, status=HTTPStatus.BAD_REQUEST)
     return JsonResponse(res)
 
+def _search_response(res):
+    # the matches are already serialized, splice them in
+    matches = res.pop('matches')
+    body = json.dumps(res).encode()
+    body = b'{"matches": ' + matches_json(matches) + b", " + body[1:]
+    return HttpResponse(body, content_type="application/json")
+
+@user_passes_test(lambda user: user.is_superuser)
+def api_search_cache_stats(request):
+    cache = get_search_cache()
+    if cache:
+        return JsonResponse(cache.stats())
+    else:
+        return JsonResponse({ "backend": None })
+
+@login_required
+def api_reindex_job(request, job_id):
+    try:
+        job = ReindexJob.objects.get(pk=job_id)
+    except ReindexJob.DoesNotExist:
+        raise Http404("Job not found")
+    if job.user_id != request.user.id and not request.user.is_superuser:
+        raise Http404("Job not found")
+    return JsonResponse(job.as_api_dict())
+
+def api_suggest(request):
+    try:
+        limit = min(int(request.GET.get('limit', 10)), 50)
+    except ValueError:
+        limit = 10
+    query = request.GET.get('query', '')
+    # same logic of _active_libraries: logged in users see the
+    # private libraries as well
+    suggestions = suggest(settings.XAPIAN_DB,
+                          query,
+                          public_only=not request.user.is_authenticated,
+                          limit=limit,
+                          active_libraries=_active_libraries(request.user))
+    return JsonResponse({ "query": query, "suggestions": suggestions })
+
+class _Echo:
+    # file-like object for csv.writer, just hand back the row
+    def write(self, value):
+        return value
+
+def _csv_row(hit):
+    rec = json.loads(hit)
+    titles = [ t['value'] for t in rec.get('title', []) ]
+    return [
+        rec.get('entry_id'),
+        titles[0] if titles else "",
+        titles[1] if len(titles) > 1 else "",
+        "; ".join([ a['value'] for a in rec.get('creator', []) ]),
+        " ".join([ str(d['value']) for d in rec.get('date', []) ]),
+        " ".join([ l['value'] for l in rec.get('language', []) ]),
+        "; ".join(sorted(set([ ds['library_name'] for ds in rec['data_sources'] ]))),
+        " ".join([ ds['uri'] for ds in rec['data_sources'] if ds.get('uri') ]),
+    ]
+
+def api_export(request, export_format):
+    if export_format not in ('csv', 'jsonl'):
+        raise Http404("Invalid format")
+    active_libraries, exclusions = _search_restrictions(request.user)
+    hits = search_all(
+        settings.XAPIAN_DB,
+        request.GET,
+        chunk_size=settings.EXPORT_CHUNK_SIZE,
+        active_libraries=active_libraries,
+        exclusions=exclusions,
+    )
+    # the first chunk is searched here, so a bad request is still
+    # a proper error and not a truncated download
+    try:
+        first = next(hits, None)
+    except ValueError as error:
+        return JsonResponse({ "error": str(error) }, status=HTTPStatus.BAD_REQUEST)
+    if first is not None:
+        hits = itertools.chain([ first ], hits)
+
+    filename = "mycorrhiza-export-{}.{}".format(datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ'), export_format)
+    if export_format == 'csv':
+        writer = csv.writer(_Echo())
+        header = [ "entry_id", "title", "subtitle", "authors", "dates", "languages", "libraries", "urls" ]
+        rows = itertools.chain([ writer.writerow(header) ],
+                               (writer.writerow(_csv_row(hit)) for hit in hits))
+        response = StreamingHttpResponse(rows, content_type="text/csv")
+    else:
+        response = StreamingHttpResponse((hit + b"\n" for hit in hits), content_type="application/x-ndjson")
+    response.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+    return response
+
 class LatestEntriesFeed(Feed):
     title = 'Latest entries'
     link = "{}/feed".format(settings.CANONICAL_ADDRESS)
@@ -277,8 +414,14 @@ def get_datasource_full_text(request, ds_id):
     ds = get_object_or_404(DataSource, pk=ds_id)
     out = {}
     html = ""
+    stored = None
     if ds.site.library_id in _active_libraries(request.user):
         html = ds.full_text()
+        stored = ds.stored_text()
+        if html and stored:
+            etag = '"{}"'.format(stored.sha256)
+            if request.headers.get('If-None-Match') == etag:
+                return HttpResponseNotModified()
 
     def replace_images(m):
         src = reverse('api_get_datasource_file', args=[ds.id, m.group(1)])
@@ -286,7 +429,11 @@ def get_datasource_full_text(request, ds_id):
 
     if html:
         out['html'] = re.sub(r'src="([0-9a-z-]+\.(jpe?g|png))"', replace_images, html)
-    return JsonResponse(out)
+    response = JsonResponse(out)
+    if html and stored:
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(stored.fetched.timestamp())
+    return response
 
 def get_datasource_file(request, ds_id, filename):
     ds = get_object_or_404(DataSource, pk=ds_id)
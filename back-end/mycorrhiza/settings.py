@@ -145,6 +145,55 @@ LOGGING = {
 }
 
 XAPIAN_DB = str(Path(__file__).resolve().parent.parent.joinpath('xapian', 'db'))
+# documents written between commits when indexing
+XAPIAN_INDEX_BATCH_SIZE = 1000
+# how the text fields are indexed on a rebuild, see INDEX_LAYOUTS in
+# amwmeta/xapian.py and the benchmark_index_layouts command
+XAPIAN_INDEX_LAYOUT = "full"
+# worker processes for harvest --reindex
+XAPIAN_INDEX_WORKERS = 1
+# keep the shards built by the workers and search across them instead
+# of merging them into a single database
+XAPIAN_SHARDED_INDEX = False
+# the rebuilds go into a new generation of the index, switched in
+# when ready. Keep this many around for harvest --rollback.
+XAPIAN_KEEP_GENERATIONS = 3
+# queue the reindexing after merges, translations and aggregations for
+# the index_worker command instead of doing it in the request. Only
+# with the index_worker running, or the changes never reach the index.
+XAPIAN_INDEX_IN_BACKGROUND = False
+# seconds between the index_worker polls
+XAPIAN_INDEX_WORKER_INTERVAL = 5
+# slowest entries recorded in the indexing stats of each harvest
+INDEX_PROFILE_KEEP = 20
+# exact, sampled (stop counting after XAPIAN_FACET_CHECKATLEAST
+# matches and scale the counts) or none
+XAPIAN_FACET_MODE = "exact"
+XAPIAN_FACET_CHECKATLEAST = 10000
+
+# cache for the /api search results, keyed on the Xapian revision.
+# BACKEND is "local" (per process LRU), "django" (use the CACHES
+# entry named by ALIAS) or None to disable it.
+SEARCH_CACHE = {
+    "BACKEND": "local",
+    "ALIAS": "default",
+    "TIMEOUT": 300,
+    "MAX_ENTRIES": 1000,
+}
+
+# local copy of the amusewiki full texts, revalidated when the record
+# changes or when older than FULL_TEXT_MAX_AGE seconds (None: never)
+FULL_TEXT_STORE = str(Path(__file__).resolve().parent.parent.joinpath('var', 'full-texts'))
+FULL_TEXT_MAX_AGE = 30 * 24 * 60 * 60
+FULL_TEXT_TIMEOUT = 30
+# concurrent downloads of the full texts when indexing, and the
+# maximum against a single site
+FULL_TEXT_WORKERS = 8
+FULL_TEXT_PER_HOST = 4
+FULL_TEXT_RETRIES = 2
+
+# number of matches fetched at once by the streaming export
+EXPORT_CHUNK_SIZE = 500
 MYCORRHIZA_EMAIL_FROM = "root@localhost"
 
 AUTH_PASSWORD_VALIDATORS = [